@@ -0,0 +1,155 @@
+import fcntl
+import glob
+import itertools as it
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+CHECKPOINT_FILE = "checkpoint.npz"
+FINISHED_FILE = "finished.json"
+LOCK_FILE = "run.lock"
+# a resumed run appends a new event file to its directory, the files of other runs are never stitched together
+RESUMED_FILE = "resumed"
+
+
+def _write(path, arrays, meta):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez(file, __meta__=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_path, path)
+
+
+def create_run_dir(parent, time, run_name, worker=None):
+    """Creates <parent>/<time>/<run_name> and returns its path. The directory is new: runs of the same
+    configuration started within the same second (e.g. concurrent repeats) get <time>_1, <time>_2, ... instead.
+    With a worker name (queue workers on several nodes sharing the log directory) it is <time>_<worker>."""
+    if worker is not None:
+        time = "{}_{}".format(time, worker)
+    for n in it.count():
+        prefix = os.path.join(parent, time if n == 0 else "{}_{}".format(time, n), run_name)
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        try:
+            # fails if another run took the name first
+            os.mkdir(prefix)
+        except FileExistsError:
+            continue
+        return prefix
+
+
+def load_checkpoint(prefix):
+    """Variable values by name and metadata of the checkpoint of a run, (None, None) if there is none."""
+    path = os.path.join(prefix, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None, None
+    with np.load(path) as data:
+        meta = json.loads(str(data["__meta__"]))
+        values = {name: data["var_{}".format(i)] for i, name in enumerate(meta["variables"])}
+        rng_state = tuple([meta["rng_state"][0], data["rng_keys"]] + meta["rng_state"][1:])
+    meta["rng_state"] = rng_state
+    return values, meta
+
+
+def lock_run(prefix):
+    """Lock of a run directory, held by the process running it until the returned file is closed (or the process
+    exits); None if another run holds it."""
+    lock = open(os.path.join(prefix, LOCK_FILE), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def claim_unfinished(run_pattern, **meta):
+    """(prefix, lock, values, meta) of the oldest run directory matching the glob pattern that still has a checkpoint
+    with the given metadata (e.g. repeat and epochs) and that no other run holds, locked (see lock_run) for the
+    caller. None if there is none."""
+    for prefix in sorted(os.path.dirname(path) for path in glob.glob(os.path.join(run_pattern, CHECKPOINT_FILE))):
+        lock = lock_run(prefix)
+        if lock is None:
+            continue
+        values, checkpoint_meta = load_checkpoint(prefix)
+        if checkpoint_meta is not None and all(checkpoint_meta.get(key) == value for key, value in meta.items()):
+            return prefix, lock, values, checkpoint_meta
+        lock.close()
+    return None
+
+
+def mark_finished(prefix, **meta):
+    """Records in the run directory that the run is complete (with e.g. its epochs and final loss)."""
+    path = os.path.join(prefix, FINISHED_FILE)
+    with open(path + ".tmp", "w") as file:
+        json.dump(meta, file)
+    os.replace(path + ".tmp", path)
+
+
+def mark_resumed(prefix):
+    """Records in the run directory that its event files continue each other."""
+    open(os.path.join(prefix, RESUMED_FILE), "w").close()
+
+
+def find_finished(run_pattern):
+    """Metadata of the finished runs in directories matching the glob pattern, oldest first."""
+    finished = []
+    for path in sorted(glob.glob(os.path.join(run_pattern, FINISHED_FILE))):
+        with open(path) as file:
+            finished.append(json.load(file))
+    return finished
+
+
+def restore(sess, variables, values):
+    """Loads the saved values into variables given by name."""
+    for name, variable in variables.items():
+        if name in values:
+            variable.load(values[name], sess)
+
+
+class AsyncCheckpoint(object):
+    """Periodic checkpoints of a run: the variables are fetched from the session (a consistent snapshot between
+    two train steps) and written to <prefix>/checkpoint.npz by a background thread while training goes on."""
+
+    def __init__(self, prefix, every_steps=None, every_secs=None):
+        self.path = os.path.join(prefix, CHECKPOINT_FILE)
+        self.every_steps = every_steps
+        self.every_secs = every_secs
+        self._last_step = 0
+        self._last_time = time.time()
+        self._thread = None
+
+    def due(self, step):
+        if self.every_steps is not None and step - self._last_step >= self.every_steps:
+            return True
+        return self.every_secs is not None and time.time() - self._last_time >= self.every_secs
+
+    def save(self, sess, variables, step, epoch_rng_state, **meta):
+        """variables: {name: variable} to save."""
+        names = list(variables)
+        values = sess.run([variables[name] for name in names])
+        self._last_step = step
+        self._last_time = time.time()
+
+        name, keys, *rng_state = epoch_rng_state
+        arrays = {"var_{}".format(i): value for i, value in enumerate(values)}
+        arrays["rng_keys"] = keys
+        meta = dict(meta,
+                    step=step,
+                    variables=names,
+                    rng_state=[name] + [float(x) if isinstance(x, float) else int(x) for x in rng_state])
+        # at most one write in flight
+        self.wait()
+        self._thread = threading.Thread(target=_write, args=(self.path, arrays, meta), daemon=True)
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def remove(self):
+        self.wait()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+from util_plot import *
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import socketserver
+import threading
+import numpy as np
+
+DEFAULT_PORT = 6007
+DEFAULT_CACHE_MB = 256
+DEFAULT_POINTS = 500
+
+
+# http.server.ThreadingHTTPServer is python 3.7+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>runs</title>
+<style>
+body { font-family: sans-serif; margin: 0; display: flex; height: 100vh; }
+#side { width: 420px; overflow-y: auto; border-right: 1px solid #ccc; padding: 8px; font-size: 12px; }
+#main { flex: 1; padding: 8px; }
+#filter { width: 100%; margin-bottom: 6px; }
+svg { width: 100%; height: 90%; }
+</style>
+</head>
+<body>
+<div id="side">
+  <input id="filter" placeholder="filter, e.g. UCI_Bank test adam">
+  <div>
+    <select id="metric"><option>cross_entropy</option><option>accuracy</option></select>
+    <label><input type="checkbox" id="log"> log scale</label>
+  </div>
+  <div id="runs"></div>
+</div>
+<div id="main"><svg id="plot"></svg><div id="legend"></div></div>
+<script>
+const colors = ["#3498db", "#e74c3c", "#2ecc71", "#9b59b6", "#f39c12", "#1abc9c", "#34495e", "#7f8c8d"];
+let runs = [];
+let selected = new Set();
+let curves = {};
+
+async function loadRuns() {
+  runs = await (await fetch("api/runs")).json();
+  showRuns();
+}
+
+function showRuns() {
+  const words = document.getElementById("filter").value.split(" ").filter(w => w);
+  const div = document.getElementById("runs");
+  div.innerHTML = "";
+  for (const run of runs) {
+    const name = run.key.join(" ");
+    if (!words.every(w => name.includes(w))) continue;
+    const label = document.createElement("label");
+    const box = document.createElement("input");
+    box.type = "checkbox";
+    box.checked = selected.has(name);
+    box.onchange = () => { box.checked ? selected.add(name) : selected.delete(name); draw(); };
+    label.appendChild(box);
+    label.appendChild(document.createTextNode(name + " (" + run.runs + ")"));
+    div.appendChild(label);
+    div.appendChild(document.createElement("br"));
+  }
+}
+
+async function curve(name) {
+  const metric = document.getElementById("metric").value;
+  const id = name + "|" + metric;
+  if (!(id in curves)) {
+    const [dataset, mode, architecture, algo] = name.split(" ");
+    const query = new URLSearchParams({dataset, mode, architecture, algo, key: metric,
+                                       points: document.getElementById("plot").clientWidth});
+    curves[id] = await (await fetch("api/curve?" + query)).json();
+  }
+  return curves[id];
+}
+
+async function draw() {
+  const svg = document.getElementById("plot");
+  const legend = document.getElementById("legend");
+  const log = document.getElementById("log").checked;
+  const names = [...selected];
+  const data = await Promise.all(names.map(curve));
+  const f = y => log ? Math.log10(Math.max(y, 1e-12)) : y;
+  let xs = [], ys = [];
+  for (const d of data) {
+    xs.push(...d.steps);
+    d.mean.forEach((m, i) => { if (isFinite(m)) ys.push(f(m - d.std[i]), f(m + d.std[i])); });
+  }
+  ys = ys.filter(isFinite);
+  const w = svg.clientWidth, h = svg.clientHeight;
+  const [x0, x1, y0, y1] = [Math.min(...xs), Math.max(...xs), Math.min(...ys), Math.max(...ys)];
+  const px = x => 40 + (x - x0) / ((x1 - x0) || 1) * (w - 50);
+  const py = y => h - 20 - (f(y) - y0) / ((y1 - y0) || 1) * (h - 30);
+  let out = "";
+  legend.innerHTML = "";
+  data.forEach((d, c) => {
+    const color = colors[c % colors.length];
+    const upper = d.steps.map((s, i) => px(s) + "," + py(d.mean[i] + d.std[i]));
+    const lower = d.steps.map((s, i) => px(s) + "," + py(d.mean[i] - d.std[i])).reverse();
+    out += `<polygon points="${upper.concat(lower).join(" ")}" fill="${color}" opacity="0.2"/>`;
+    out += `<polyline points="${d.steps.map((s, i) => px(s) + "," + py(d.mean[i])).join(" ")}"
+             fill="none" stroke="${color}" stroke-width="1.5"/>`;
+    legend.innerHTML += `<span style="color:${color}">&#9632; ${names[c]} (${d.runs} runs)</span><br>`;
+  });
+  if (data.length > 0) {
+    out += `<text x="40" y="${h - 4}" font-size="11">${x0}</text>`;
+    out += `<text x="${w - 60}" y="${h - 4}" font-size="11">${x1}</text>`;
+    out += `<text x="0" y="12" font-size="11">${(log ? 10 ** y1 : y1).toPrecision(3)}</text>`;
+    out += `<text x="0" y="${h - 22}" font-size="11">${(log ? 10 ** y0 : y0).toPrecision(3)}</text>`;
+  }
+  svg.innerHTML = out;
+}
+
+document.getElementById("filter").oninput = showRuns;
+document.getElementById("metric").onchange = draw;
+document.getElementById("log").onchange = draw;
+loadRuns();
+</script>
+</body>
+</html>
+"""
+
+
+class _LRUCache(object):
+    """Thread safe LRU cache bounded by the total size (in bytes) of the cached values."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key)[1]
+            self._items[key] = value, size
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self._items) > 1:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.bytes -= evicted_size
+
+
+class Dashboard(object):
+    def __init__(self, log_dir, cache_mb=DEFAULT_CACHE_MB, verbose=False):
+        self.log_dir = log_dir
+        self.tree = Tree(verbose=verbose)
+        self.cache = _LRUCache(cache_mb * 2 ** 20)
+        self._lock = threading.Lock()
+
+    def runs(self):
+        with self._lock:
+            sources = dict(self.tree.find_runs(self.log_dir))
+            self.sources = sources
+        return [{"key": list(key), "runs": len(files)} for key, files in sorted(sources.items())]
+
+    def stats(self, run_key, metric):
+        files = self.sources.get(run_key, [])
+        stamps = []
+        for filename in files:
+            stat = os.stat(filename)
+            stamps.append((filename, stat.st_mtime_ns, stat.st_size))
+        # a changed or new event file changes the key, stale entries just age out
+        cache_key = run_key, metric, tuple(stamps)
+        stats = self.cache.get(cache_key)
+        if stats is None:
+            stats = RunningStats()
+            for filename in files:
+                steps, values = read_events(filename, metric)
+                stats.add(steps[1:], values[1:])
+            size = sum(a.nbytes for a in (stats.steps, stats.count, stats.mean, stats.min, stats.max, stats._m2))
+            self.cache.put(cache_key, stats, size)
+        return stats
+
+    def curve(self, run_key, metric, points=DEFAULT_POINTS, downsample="lttb"):
+        stats = self.stats(run_key, metric)
+        indices = downsample_indices(stats.steps, stats.mean, points, downsample)
+
+        def to_list(array):
+            return [None if not np.isfinite(v) else float(v) for v in array[indices]]
+
+        return {"steps": [int(s) for s in stats.steps[indices]],
+                "mean": to_list(stats.mean),
+                "std": to_list(stats.std),
+                "min": to_list(stats.min),
+                "max": to_list(stats.max),
+                "runs": stats.runs}
+
+
+def _handler(dashboard):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, body, content_type="application/json", status=200):
+            body = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            try:
+                if url.path == "/":
+                    self._send(PAGE, content_type="text/html; charset=utf-8")
+                elif url.path == "/api/runs":
+                    self._send(json.dumps(dashboard.runs()))
+                elif url.path == "/api/curve":
+                    if not hasattr(dashboard, "sources"):
+                        dashboard.runs()
+                    run_key = tuple(query[k] for k in ("dataset", "mode", "architecture", "algo"))
+                    curve = dashboard.curve(run_key,
+                                            query.get("key", "cross_entropy"),
+                                            points=int(query.get("points", DEFAULT_POINTS)),
+                                            downsample=query.get("downsample", "lttb"))
+                    self._send(json.dumps(curve))
+                else:
+                    self._send(json.dumps({"error": "not found"}), status=404)
+            except (KeyError, ValueError) as ex:
+                self._send(json.dumps({"error": str(ex)}), status=400)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(log_dir, port=DEFAULT_PORT, host="localhost", cache_mb=DEFAULT_CACHE_MB, verbose=False):
+    dashboard = Dashboard(log_dir, cache_mb=cache_mb, verbose=verbose)
+    server = ThreadingHTTPServer((host, port), _handler(dashboard))
+    print("Serving runs from '{}' at http://{}:{}/".format(log_dir, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Small local dashboard for browsing many runs (instead of tensorboard).",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--log_dir",
+                        default="tb_logs_linear")
+    parser.add_argument("--port", "-p", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--cache-mb", type=int, default=DEFAULT_CACHE_MB,
+                        help="memory budget for aggregated curves kept in memory")
+    parser.add_argument("--verbose", "-v",
+                        action="store_true",
+                        default=False)
+    args = parser.parse_args()
+
+    serve(args.log_dir, port=args.port, host=args.host, cache_mb=args.cache_mb, verbose=args.verbose)
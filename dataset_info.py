@@ -0,0 +1,133 @@
+import json
+import os
+import statistics
+import threading
+
+import numpy as np
+
+import dataset_stats
+
+# Small cache of dataset descriptors and observed runtimes, so that sweeps can be planned and ordered
+# without loading any data (and without importing tensorflow).
+INFO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".dataset_info.json")
+# relative cost of a train step on top of the work proportional to the batch
+STEP_OVERHEAD = 1000
+# config keys the dataset constructors in datasets.py take, a descriptor is cached for every combination of them
+DATA_CONFIG_KEYS = ("train_batchsize", "test_batchsize", "convert_labels_to_one_hot", "sparse_labels", "seed",
+                    "test_ratio", "size", "num_features", "distribution", "seq_len", "window_stride",
+                    "random_windows")
+
+
+def _load():
+    try:
+        with open(INFO_FILE) as file:
+            info = json.load(file)
+    except (OSError, ValueError):
+        info = {}
+    info.setdefault("datasets", {})
+    info.setdefault("runtimes", {})
+    return info
+
+
+def _save(info):
+    # concurrent writers may lose each other's updates, which only makes estimates a bit worse
+    tmp_path = "{}.{}.{}.tmp".format(INFO_FILE, os.getpid(), threading.get_ident())
+    with open(tmp_path, "w") as file:
+        json.dump(info, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, INFO_FILE)
+
+
+def _descriptor_key(dataset_name, config):
+    data_config = {key: config.get(key) for key in DATA_CONFIG_KEYS if config.get(key) is not None}
+    if len(data_config) == 0:
+        return dataset_name
+    return "{} {}".format(dataset_name, json.dumps(data_config, sort_keys=True, default=str))
+
+
+def describe(dataset_name, config):
+    """Cached descriptor of a dataset (by its name in configs) loaded with the data options of the config, None if
+    it was never loaded so."""
+    return _load()["datasets"].get(_descriptor_key(dataset_name, config))
+
+
+def record_dataset(dataset_name, dataset, config, with_statistics=False):
+    """Stores the descriptor of a dataset loaded with the config, with_statistics also summaries of dataset_stats
+    (which take a pass over the data the first time)."""
+    info = _load()
+    features = 1
+    for dim in dataset.input_shape:
+        features *= int(dim)
+    key = _descriptor_key(dataset_name, config)
+    descriptor = info["datasets"].get(key, {})
+    descriptor.update({"name": dataset.get_name(),
+                       "train_size": len(dataset.train[0]),
+                       "test_size": len(dataset.test[0]),
+                       "features": features,
+                       "input_shape": [int(dim) for dim in dataset.input_shape],
+                       "outputs": int(dataset.outputs_num),
+                       "task": dataset.task,
+                       "sequential": bool(dataset.sequential),
+                       "use_embeddings": bool(dataset.use_embeddings),
+                       "tokens_num": int(getattr(dataset, "tokens_num", 0)),
+                       "input_scale": getattr(dataset, "input_scale", None),
+                       "sparse_labels": bool(getattr(dataset, "sparse_labels", False)),
+                       "input_itemsize": int(dataset.train[0].dtype.itemsize),
+                       "label_itemsize": int(dataset.train[1].dtype.itemsize),
+                       "label_width": int(np.prod(dataset.train[1].shape[1:], dtype=np.int64))})
+    if with_statistics:
+        stats = dataset.statistics
+        descriptor.update({"feature_scale": float(dataset_stats.feature_scale(stats)),
+                           "feature_spread": float(dataset_stats.feature_spread(stats)),
+                           "sparsity": float(dataset_stats.sparsity(stats)),
+                           "label_counts": [int(count) for count in stats["label_counts"]]})
+    info["datasets"][key] = descriptor
+    _save(info)
+
+
+def _runtime_key(name, model, optimizer_class, batchsize):
+    return "{}/{}/{}/b{}".format(name, model, optimizer_class, batchsize)
+
+
+def record_runtime(dataset, model, optimizer_class, epochs, seconds):
+    info = _load()
+    key = _runtime_key(dataset.get_name(), model, optimizer_class, dataset.train_batchsize)
+    total_epochs, total_seconds = info["runtimes"].get(key, (0, 0.0))
+    info["runtimes"][key] = total_epochs + epochs, total_seconds + seconds
+    _save(info)
+
+
+def _model_cost(descriptor, epochs, batchsize):
+    steps = epochs * descriptor["train_size"] / batchsize
+    return steps * (STEP_OVERHEAD + batchsize * descriptor["features"] * max(descriptor["outputs"], 1))
+
+
+def estimate_costs(jobs, default_epochs=1):
+    """Estimated seconds of every job (dicts with dataset, model, optimizer_class and config).
+
+    Jobs of a (dataset, model, optimizer) that ran before are estimated from the observed time per epoch,
+    the others from the number of steps and features, scaled by how the same estimate compared to the observed
+    runtimes. Jobs of datasets that were never loaded get the largest estimate."""
+    info = _load()
+    costs = []
+    ratios = []
+    for job in jobs:
+        descriptor = info["datasets"].get(_descriptor_key(job["dataset"], job["config"]))
+        epochs = job["config"].get("epochs") or default_epochs
+        batchsize = job["config"].get("train_batchsize") or 1
+        observed = None
+        modeled = None
+        if descriptor is not None:
+            modeled = _model_cost(descriptor, epochs, batchsize)
+            runtime = info["runtimes"].get(_runtime_key(descriptor["name"], job["model"], job["optimizer_class"],
+                                                        batchsize))
+            if runtime is not None and runtime[0] > 0:
+                observed = epochs * runtime[1] / runtime[0]
+                ratios.append(observed / modeled)
+        costs.append((observed, modeled))
+
+    scale = statistics.median(ratios) if len(ratios) > 0 else 1.0
+    estimates = [observed if observed is not None else None if modeled is None else modeled * scale
+                 for observed, modeled in costs]
+    known = [estimate for estimate in estimates if estimate is not None]
+    unknown = max(known) if len(known) > 0 else 1.0
+    return [unknown if estimate is None else estimate for estimate in estimates]
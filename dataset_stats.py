@@ -0,0 +1,141 @@
+import hashlib
+import os
+
+import numpy as np
+
+# per feature statistics of the datasets, next to the descriptors cached by dataset_info.py
+STATS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".dataset_stats")
+CHUNK_ROWS = 4096
+
+
+class FeatureStats(object):
+    """Per feature statistics accumulated over chunks of rows in O(features) memory. Means and variances of the
+    chunks are merged with the pairwise update of Chan et al., which stays accurate over many rows."""
+
+    def __init__(self, features):
+        self.rows = 0
+        self.sum_squares = np.zeros(features)
+        self.max_abs = np.zeros(features)
+        self.mean = np.zeros(features)
+        self.m2 = np.zeros(features)
+        self.nonzero = np.zeros(features, dtype=np.int64)
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64).reshape(len(chunk), -1)
+        rows = len(chunk)
+        if rows == 0:
+            return
+        self.sum_squares += np.einsum("ij,ij->j", chunk, chunk)
+        np.maximum(self.max_abs, np.abs(chunk).max(0), out=self.max_abs)
+        self.nonzero += np.count_nonzero(chunk, axis=0)
+
+        mean = chunk.mean(0)
+        m2 = ((chunk - mean) ** 2).sum(0)
+        total = self.rows + rows
+        delta = mean - self.mean
+        self.mean += delta * rows / total
+        self.m2 += m2 + delta ** 2 * (self.rows * rows / total)
+        self.rows = total
+
+
+def _chunks(array, chunk_rows):
+    for start in range(0, len(array), chunk_rows):
+        yield array[start:start + chunk_rows]
+
+
+def _add_counts(total, counts):
+    if total is None:
+        return counts
+    if len(counts) > len(total):
+        total, counts = counts, total
+    total[:len(counts)] += counts
+    return total
+
+
+def _fingerprint(dataset):
+    sha = hashlib.sha1()
+    for x in (dataset.train[0], dataset.test[0]):
+        sha.update(str(np.shape(x)).encode())
+        if len(x) > 0:
+            sha.update(np.ascontiguousarray(x[0]).tobytes())
+            sha.update(np.ascontiguousarray(x[-1]).tobytes())
+    return sha.hexdigest()
+
+
+def compute(dataset, chunk_rows=CHUNK_ROWS):
+    """Statistics of the inputs and labels of train and test together, in a single pass over chunks of rows."""
+    features = 1
+    for dim in dataset.input_shape:
+        features *= int(dim)
+    inputs = FeatureStats(features)
+    # of the inputs the model gets
+    scale = getattr(dataset, "input_scale", None) or 1.0
+    label_counts = None
+    for x, y in (dataset.train, dataset.test):
+        for chunk in _chunks(x, chunk_rows):
+            inputs.update(np.asarray(chunk, dtype=np.float64) * scale)
+        # datasets.CLASSIFICATION, not imported to keep this module free of sklearn
+        if dataset.task != "classification":
+            continue
+        for chunk in _chunks(y, chunk_rows):
+            if dataset.one_hot_labels:
+                counts = np.asarray(chunk).sum(0)
+            else:
+                counts = np.bincount(np.asarray(chunk, dtype=np.int64).ravel(), minlength=2)
+            label_counts = _add_counts(label_counts, counts.astype(np.int64))
+
+    return {"fingerprint": _fingerprint(dataset),
+            "rows": inputs.rows,
+            "l2norm": np.sqrt(inputs.sum_squares),
+            "max_abs": inputs.max_abs,
+            "mean": inputs.mean,
+            "var": inputs.m2 / max(inputs.rows, 1),
+            "nonzero": inputs.nonzero,
+            "label_counts": label_counts if label_counts is not None else np.zeros(0, dtype=np.int64)}
+
+
+def _path(name):
+    return os.path.join(STATS_DIR, name + ".npz")
+
+
+def load_statistics(name):
+    """Saved statistics of a dataset by its name (Dataset.get_name()), None if they were never computed."""
+    try:
+        with np.load(_path(name)) as data:
+            stats = {key: data[key] for key in data.files}
+    except (OSError, ValueError):
+        return None
+    stats["fingerprint"] = str(stats["fingerprint"])
+    stats["rows"] = int(stats["rows"])
+    return stats
+
+
+def statistics(dataset, chunk_rows=CHUNK_ROWS):
+    """Statistics of a loaded dataset, computed once and saved in STATS_DIR."""
+    stats = load_statistics(dataset.get_name())
+    if stats is not None and stats["fingerprint"] == _fingerprint(dataset):
+        return stats
+    stats = compute(dataset, chunk_rows)
+    os.makedirs(STATS_DIR, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(_path(dataset.get_name()), os.getpid())
+    with open(tmp_path, "wb") as file:
+        np.savez(file, **stats)
+    os.replace(tmp_path, _path(dataset.get_name()))
+    return stats
+
+
+def feature_scale(stats):
+    """Ratio of the largest to the smallest nonzero L2 norm of a feature."""
+    l2norm = stats["l2norm"][stats["l2norm"] > 0]
+    return l2norm.max() / l2norm.min()
+
+
+def feature_spread(stats):
+    """Ratio of the largest to the smallest nonzero max |x| of a feature."""
+    max_abs = stats["max_abs"][stats["max_abs"] > 0]
+    return max_abs.max() / max_abs.min()
+
+
+def sparsity(stats):
+    """Fraction of zero inputs."""
+    return 1.0 - stats["nonzero"].sum() / max(stats["rows"] * len(stats["nonzero"]), 1)
@@ -3,6 +3,11 @@
 import os
 import sys
 import pickle
+import tarfile
+import zipfile
+from contextlib import contextmanager
+import dataset_stats
+import download
 from distributions import *
 
 from sklearn.model_selection import train_test_split
@@ -10,6 +15,9 @@ from preprocess import load_text
 
 # from sklearn.metrics.pairwise import sigmoid_kernel
 
+# bump whenever the data fed to the models changes, it invalidates results cached by test.py --cache
+PREPROCESSING_VERSION = 2
+
 MNIST_DOWNLOAD_DIR = '/tmp/mnist_data/'
 MNIST_LECUN_URL = "http://yann.lecun.com/exdb/mnist/"
 MNIST_MIRROR_URL = 'https://storage.googleapis.com/cvdf-datasets/mnist/'
@@ -20,6 +28,9 @@ MNIST_TRAIN_LABELS_FILENAME = 'train-labels-idx1-ubyte.gz'
 MNIST_TEST_IMAGES_FILENAME = 't10k-images-idx3-ubyte.gz'
 MNIST_TEST_LABELS_FILENAME = 't10k-labels-idx1-ubyte.gz'
 MNIST_DATA_SHAPE = (28, 28, 1)
+# bytes before the data in the idx files
+MNIST_IMAGES_OFFSET = 16
+MNIST_LABELS_OFFSET = 8
 MNIST_CLASSES_NUM = 10
 
 UCI_DATASETS = "http://archive.ics.uci.edu/ml/machine-learning-databases"
@@ -39,10 +50,18 @@ UCI_CTSCAN_URL = UCI_DATASETS + "/00206/slice_localization_data.zip"
 
 CIFAR_URL = 'https://www.cs.toronto.edu/~kriz/cifar-10-python.tar.gz'
 CIFAR_DOWNLOAD_DIR = '/tmp/cifar10_data'
-CIFAR_EXTRACT_PATH = 'cifar-10-batches-py'
 CIFAR_DATA_SHAPE = (32, 32, 3)
 CIFAR_CLASSESS_NUM = 10
 
+# sha256 of the downloaded archives (as listed in the url checksums of tensorflow_datasets), checked by download.fetch
+DOWNLOAD_SHA256 = {
+    MNIST_TRAIN_IMAGES_FILENAME: "440fcabf73cc546fa21475e81ea370265605f56be210a4024d2ca8f203523609",
+    MNIST_TRAIN_LABELS_FILENAME: "3552534a0a558bbed6aed32b30c495cca23d567ec52cac8be1a0730e8010255c",
+    MNIST_TEST_IMAGES_FILENAME: "8d422c7b0a1c1c79245a5bcf07fe86e33eeafee792b84584aec276f5a2dbc4e6",
+    MNIST_TEST_LABELS_FILENAME: "f7ae60f92e00ec6debd23a6088c31dbd2371eca3ffa0defaefb259924204aec6",
+    CIFAR_URL.split("/")[-1]: "6d958be074577803d12ecdefd02955f39262c83c16fe9348329d7fe0b5c001ce",
+}
+
 WNP_LINK = "https://cs.stanford.edu/people/karpathy/char-rnn/warpeace_input.txt"
 WNP_DOWNLOAD_DIR = "/tmp/war_and_peace"
 WNP_FILE = os.path.join(WNP_DOWNLOAD_DIR, "warpeace_input.txt")
@@ -61,6 +80,51 @@ def _to_one_hot(int_labels):
     return enc.fit_transform(int_labels.reshape([-1, 1])).toarray()
 
 
+def _load_matrix(path, dtype=np.float32, chunk_bytes=1 << 24):
+    """Matrix of a text file with rows of numbers separated by whitespace, parsed in C a chunk of lines at a time
+    straight into dtype."""
+    chunks = []
+    columns = None
+    rest = b""
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(chunk_bytes)
+            if not data:
+                lines, rest = rest, b""
+            else:
+                data = rest + data
+                end = data.rfind(b"\n") + 1
+                lines, rest = data[:end], data[end:]
+            rows = [line for line in lines.split(b"\n") if line.strip()]
+            if len(rows) > 0:
+                if columns is None:
+                    columns = len(rows[0].split())
+                if any(len(row.split()) != columns for row in rows):
+                    raise ValueError("Rows of {} have different lengths".format(path))
+                # fromstring stops at the first non numeric value, which the count reveals
+                values = np.fromstring(b"\n".join(rows), dtype=dtype, sep=" ")
+                if len(values) != len(rows) * columns:
+                    raise ValueError("Rows of {} are not numeric".format(path))
+                chunks.append(values.reshape(-1, columns))
+            if not data:
+                break
+    if columns is None:
+        return np.zeros((0, 0), dtype=dtype)
+    return np.concatenate(chunks)
+
+
+@contextmanager
+def _archive_member(archive, member):
+    """Binary file object of a member of a zip or tar archive, read without extracting it. Nothing is written,
+    so any number of processes can load the same dataset at once."""
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zip_file, zip_file.open(member) as file:
+            yield file
+    else:
+        with tarfile.open(archive) as tar_file:
+            yield tar_file.extractfile(member)
+
+
 # TODO some regression tasks?
 class _Dataset():
     def __init__(self,
@@ -76,7 +140,11 @@ class _Dataset():
                  sequential=False,
                  use_embeddings=False,
                  task=CLASSIFICATION,
+                 input_scale=None,
+                 sparse_labels=False,
                  **kwargs):
+        # input_scale: inputs are stored as uint8 (e.g. pixels) and multiplied by it in the graph
+        # sparse_labels: classes are kept as int32 indices instead of one hot rows
         # TODO check if one hot coverter is ok for all datasets
         if num_outputs == 2:
             convert_labels_to_one_hot = False
@@ -92,13 +160,22 @@ class _Dataset():
         self.test = list(test_data)
         self.train = list(train_data)
         self.task = task
-        self.one_hot_labels = convert_labels_to_one_hot
+        self.one_hot_labels = convert_labels_to_one_hot and not sparse_labels
+        self.sparse_labels = convert_labels_to_one_hot and sparse_labels
+        self.input_scale = input_scale
 
         if self.one_hot_labels:
             if sequential:
                 raise NotImplementedError("Might now work correclty???")
             self.train[1] = _to_one_hot(self.train[1])
             self.test[1] = _to_one_hot(self.test[1])
+        elif self.sparse_labels:
+            if sequential:
+                raise NotImplementedError("Might now work correclty???")
+            # indices of the sorted classes, the columns _to_one_hot would give them
+            classes = np.unique(np.concatenate([self.train[1], self.test[1]]))
+            self.train[1] = np.searchsorted(classes, self.train[1]).astype(np.int32)
+            self.test[1] = np.searchsorted(classes, self.test[1]).astype(np.int32)
         self.train_batchsize = train_batchsize
         self.test_batchsize = test_batchsize
 
@@ -119,21 +196,19 @@ class _Dataset():
     def input_shape(self):
         return self._input_shape
 
+    @property
+    def statistics(self):
+        if getattr(self, "_statistics", None) is None:
+            self._statistics = dataset_stats.statistics(self)
+        return self._statistics
+
     @property
     def feature_scale(self):
-        all_data = np.concatenate([self.train[0], self.test[0]], axis=0)
-        flat_data = all_data.reshape(len(all_data), -1)
-        # l2norm = ((flat_data ** 2).sum(0)) ** 0.5
-        l2norm = np.linalg.norm(flat_data, axis=0)
-        l2norm = l2norm[l2norm > 0]
-        return l2norm.max() / l2norm.min()
+        return dataset_stats.feature_scale(self.statistics)
 
     @property
     def feature_spread(self):
-        all_data = np.concatenate([self.train[0], self.test[0]], axis=0)
-        flat_data = all_data.reshape(len(all_data), -1)
-        fmax = abs(flat_data).max(0)
-        return fmax.max() / fmax[fmax != 0].min()
+        return dataset_stats.feature_spread(self.statistics)
 
     def train_batches(self, batchsize=None):
         if batchsize is None:
@@ -156,23 +231,7 @@ class _Dataset():
         return self.test
 
     def maybe_download(self, url, download_path):
-        os.makedirs(download_path, exist_ok=True)
-
-        filename = url.split('/')[-1]
-        filepath = os.path.join(download_path, filename)
-        if not os.path.exists(filepath):
-            # TODO use tqdm
-            def _progress(count, block_size, total_size):
-                sys.stdout.write('\rDownloading %s %.1f%%' % (filename,
-                                                              float(count * block_size) / float(
-                                                                  total_size) * 100.0))
-                sys.stdout.flush()
-
-            from six.moves import urllib
-            filepath, _ = urllib.request.urlretrieve(url, filepath, _progress)
-            statinfo = os.stat(filepath)
-            print()
-            print('Successfully downloaded', filename, statinfo.st_size, 'bytes.')
+        return download.fetch_all([url], download_path, checksums=DOWNLOAD_SHA256)[0]
 
 
 class Cifar10(_Dataset):
@@ -180,66 +239,44 @@ class Cifar10(_Dataset):
                  name="cifar10",
                  *args, **kwargs):
         print("Loading cifar10 dataset.")
-        self.maybe_download_and_extract()
-        train_data, test_data = self.load_dataset()
+        train_data, test_data = self.load_dataset(self.maybe_download(CIFAR_URL, CIFAR_DOWNLOAD_DIR))
         super(Cifar10, self).__init__(name,
                                       train_data=train_data,
                                       test_data=test_data,
                                       input_shape=CIFAR_DATA_SHAPE,
                                       num_outputs=CIFAR_CLASSESS_NUM,
+                                      input_scale=1 / 255,
                                       *args, **kwargs)
 
-    def maybe_download_and_extract(self):
-        """Download and extract the tarball from Alex's website."""
-        if not os.path.exists(CIFAR_DOWNLOAD_DIR):
-            os.makedirs(CIFAR_DOWNLOAD_DIR)
-        filename = CIFAR_URL.split('/')[-1]
-        filepath = os.path.join(CIFAR_DOWNLOAD_DIR, filename)
-        if not os.path.exists(filepath):
-            def _progress(count, block_size, total_size):
-                sys.stdout.write('\rDownloading %s %.1f%%' % (filename,
-                                                              float(count * block_size) / float(total_size) * 100.0))
-                sys.stdout.flush()
-
-            from six.moves import urllib
-            filepath, _ = urllib.request.urlretrieve(CIFAR_URL, filepath, _progress)
-            print()
-            statinfo = os.stat(filepath)
-            print('Successfully downloaded', filename, statinfo.st_size, 'bytes.')
-        extracted_dir_path = os.path.join(CIFAR_DOWNLOAD_DIR, CIFAR_EXTRACT_PATH)
-        if not os.path.exists(extracted_dir_path):
-            import tarfile
-            tarfile.open(filepath, 'r:gz').extractall(CIFAR_DOWNLOAD_DIR)
-
-    def load_dataset(self):
-        train_filenames = [os.path.join(CIFAR_DOWNLOAD_DIR,
-                                        CIFAR_EXTRACT_PATH,
-                                        'data_batch_{}'.format(i))
-                           for i in range(1, 6)]
-        test_filename = os.path.join(CIFAR_DOWNLOAD_DIR,
-                                     CIFAR_EXTRACT_PATH,
-                                     'test_batch')
+    def load_dataset(self, tarball):
+        """Reads the batches straight from the tarball from Alex's website, in one pass over it."""
+        train_filenames = ['data_batch_{}'.format(i) for i in range(1, 6)]
+        test_filename = 'test_batch'
+        batches = {}
+        with tarfile.open(tarball, 'r:gz') as tar:
+            for member in tar:
+                filename = os.path.basename(member.name)
+                if member.isfile() and filename in train_filenames + [test_filename]:
+                    batches[filename] = pickle.load(tar.extractfile(member), encoding='latin1')
         train_images = []
         train_labels = []
 
         def process_images(ims):
-            ims = ims.reshape([-1, 3, 32, 32]).astype(np.float32) / 255
-            return np.transpose(ims, [0, 2, 3, 1])
+            ims = np.asarray(ims, dtype=np.uint8).reshape([-1, 3, 32, 32])
+            return np.ascontiguousarray(np.transpose(ims, [0, 2, 3, 1]))
 
         for filename in train_filenames:
-            with open(filename, 'rb') as file:
-                data = pickle.load(file, encoding='latin1')
-                images = data['data']
-                labels = data['labels']
-                train_images.append(images)
-                train_labels.append(labels)
+            data = batches[filename]
+            images = data['data']
+            labels = data['labels']
+            train_images.append(images)
+            train_labels.append(labels)
         train_images = process_images(np.concatenate(train_images))
         train_labels = np.concatenate(train_labels).astype(np.int64)
 
-        with open(test_filename, 'rb') as file:
-            test_data = pickle.load(file, encoding='latin1')
-            test_images = test_data['data']
-            test_labels = test_data['labels']
+        test_data = batches[test_filename]
+        test_images = test_data['data']
+        test_labels = test_data['labels']
 
         test_images = process_images(test_images)
         test_labels = np.int64(test_labels)
@@ -282,15 +319,11 @@ class UCI_Madelon(_Dataset):
         # print("Fetching Madelon dataset. It may take a while.")
         download_path = "/tmp/uci_madelon"
 
-        def download_and_extract(url):
-            self.maybe_download(url, download_path)
-            file = os.path.join(download_path, url.split("/")[-1])
-            return np.genfromtxt(file, delimiter=" ")
-
-        x_train = download_and_extract(MADELON_TRAIN)
-        x_test = download_and_extract(MADELON_TEST)
-        y_train = (download_and_extract(MADELON_TRAIN_LABELS) + 1) / 2
-        y_test = (download_and_extract(MADELON_TEST_LABELS) + 1) / 2
+        files = download.fetch_all([MADELON_TRAIN, MADELON_TEST, MADELON_TRAIN_LABELS, MADELON_TEST_LABELS],
+                                   download_path)
+        x_train, x_test, y_train, y_test = [_load_matrix(file) for file in files]
+        y_train = (y_train.ravel() + 1) / 2
+        y_test = (y_test.ravel() + 1) / 2
 
         num_outputs = 2  # len(np.unique(y))
         super(UCI_Madelon, self).__init__(name,
@@ -310,16 +343,11 @@ class UCI_Bank(_Dataset):
         # print("Fetching Bank dataset. It may take a while.")
         download_path = "/tmp/uci_bank"
 
-        self.maybe_download(UCI_BANK_URL, download_path)
-        file = os.path.join(download_path, UCI_BANK_URL.split("/")[-1])
-        import zipfile
-        zip_ref = zipfile.ZipFile(file, 'r')
-        zip_ref.extractall(download_path)
-        zip_ref.close()
+        file = self.maybe_download(UCI_BANK_URL, download_path)
 
         import pandas as pd
-        csv_file = os.path.join(download_path, "bank-additional/bank-additional-full.csv")
-        dataframe = pd.read_csv(csv_file, delimiter=";")
+        with _archive_member(file, "bank-additional/bank-additional-full.csv") as csv_file:
+            dataframe = pd.read_csv(csv_file, delimiter=";")
 
         y = np.zeros_like(dataframe["y"], dtype=np.int32)
         y[dataframe["y"] == "yes"] = 1
@@ -347,21 +375,14 @@ class UCI_Census(_Dataset):
         # print("Fetching Census dataset. It may take a while.")
         download_path = "/tmp/uci_census"
 
-        self.maybe_download(UCI_CENSUS_URL, download_path)
-
-        targzfile = os.path.join(download_path, UCI_CENSUS_URL.split("/")[-1])
+        targzfile = self.maybe_download(UCI_CENSUS_URL, download_path)
 
-        import tarfile
-        tar = tarfile.open(targzfile, mode="r")
-        tar.extractall(download_path)
-        tar.close()
-        os.chmod(download_path + "/census-income.names", 0o770)
-        os.chmod(download_path + "/census-income.data", 0o770)
-        os.chmod(download_path + "/census-income.test", 0o770)
         import pandas as pd
 
-        train_x = pd.read_csv(download_path + "/census-income.data", header=None, delimiter=",")
-        test_x = pd.read_csv(download_path + "/census-income.test", header=None, delimiter=",")
+        with _archive_member(targzfile, "census-income.data") as file:
+            train_x = pd.read_csv(file, header=None, delimiter=",")
+        with _archive_member(targzfile, "census-income.test") as file:
+            test_x = pd.read_csv(file, header=None, delimiter=",")
 
         labels_column = 41
         x = pd.concat([train_x, test_x], axis=0)
@@ -430,16 +451,11 @@ class UCI_CTScan(_Dataset):
         # print("Fetching Bank dataset. It may take a while.")
         download_path = "/tmp/uci_ctscan"
 
-        self.maybe_download(UCI_CTSCAN_URL, download_path)
-        file = os.path.join(download_path, UCI_CTSCAN_URL.split("/")[-1])
-        import zipfile
-        zip_ref = zipfile.ZipFile(file, 'r')
-        zip_ref.extractall(download_path)
-        zip_ref.close()
+        file = self.maybe_download(UCI_CTSCAN_URL, download_path)
 
         import pandas as pd
-        csv_file = os.path.join(download_path, "slice_localization_data.csv")
-        dataframe = pd.read_csv(csv_file, delimiter=",")
+        with _archive_member(file, "slice_localization_data.csv") as csv_file:
+            dataframe = pd.read_csv(csv_file, delimiter=",")
 
         # print(dataframe.shape)
         # exit(0)
@@ -472,27 +488,26 @@ class Mnist(_Dataset):
                        MNIST_TEST_IMAGES_FILENAME,
                        MNIST_TEST_LABELS_FILENAME]
 
-        for filename in mnist_files:
-            self.maybe_download(MNIST_URL + filename, MNIST_DOWNLOAD_DIR)
+        files = download.fetch_all([MNIST_URL + filename for filename in mnist_files], MNIST_DOWNLOAD_DIR,
+                                   checksums=DOWNLOAD_SHA256)
 
         # print("Loading mnist data ...")
-        from mnist import MNIST
-        mnist_loader = MNIST(MNIST_DOWNLOAD_DIR)
-        mnist_loader.gz = True
-        train_images, train_labels = mnist_loader.load_training()
-        test_images, test_labels = mnist_loader.load_testing()
-        process_images = lambda im: (np.array(im).astype(np.float32) / 255.0).reshape((- 1, 28, 28, 1))
-
-        train_images = process_images(train_images)
-        test_images = process_images(test_images)
-        train_labels = np.int64(train_labels)
-        test_labels = np.int64(test_labels)
+        def read_idx(filename, offset):
+            import gzip
+            with gzip.open(filename, 'rb') as file:
+                return np.frombuffer(file.read(), dtype=np.uint8, offset=offset)
+
+        train_images, test_images = [read_idx(filename, MNIST_IMAGES_OFFSET).reshape((-1,) + MNIST_DATA_SHAPE)
+                                     for filename in (files[0], files[2])]
+        train_labels, test_labels = [np.int64(read_idx(filename, MNIST_LABELS_OFFSET))
+                                     for filename in (files[1], files[3])]
 
         super(Mnist, self).__init__(name="mnist",
                                     train_data=(train_images, train_labels),
                                     test_data=(test_images, test_labels),
                                     input_shape=MNIST_DATA_SHAPE,
                                     num_outputs=MNIST_CLASSES_NUM,
+                                    input_scale=1 / 255,
                                     *args, **kwargs)
 
 
@@ -563,6 +578,25 @@ class SyntheticStandardized(Synthetic):
         self.test[0] = scaler.transform(self.test[0])
 
 
+def _h5_tokens(h5_file, name):
+    """Tokens of a preprocess.py output, memory mapped when they are stored contiguously."""
+    import h5py
+    with h5py.File(h5_file, 'r') as f:
+        dataset = f[name]
+        offset = dataset.id.get_offset()
+        if offset is None:
+            return dataset[:]
+        return np.memmap(h5_file, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+
+def _windows(tokens, seq_len, stride=1):
+    """View of all windows of seq_len tokens starting every stride tokens, without copying the tokens."""
+    count = max((len(tokens) - seq_len) // stride + 1, 0)
+    itemsize = tokens.strides[0]
+    return np.lib.stride_tricks.as_strided(tokens, shape=(count, seq_len), strides=(stride * itemsize, itemsize),
+                                           writeable=False)
+
+
 class _CharText(_Dataset):
     def __init__(self,
                  link,
@@ -572,19 +606,25 @@ class _CharText(_Dataset):
                  test_ratio=0.2,
                  seed=None,
                  seq_len=50,
+                 window_stride=None,
+                 random_windows=False,
                  *args,
                  **kwargs):
-        self.maybe_download(link, download_dir)
-        train, test, token_to_idx = load_text(file, test_frac=test_ratio)
+        """The train sequences are views of a single token buffer: windows starting every window_stride (seq_len,
+        i.e. no overlap, by default) tokens, or with random_windows as many windows at random offsets, drawn anew
+        every epoch. The tokens are memory mapped from <file without extension>.h5 and .json written by
+        preprocess.py when they exist (with the same test_ratio)."""
+        train, test, token_to_idx = self._load_tokens(link, file, download_dir, test_ratio)
         self.token_to_idx = token_to_idx
         self.idx_to_token = {v: k for k, v in token_to_idx.items()}
         self.tokens_num = len(token_to_idx)
-        train = train[0:len(train) - len(train) % seq_len + 1]
-        test = test[0:len(test) - len(test) % seq_len + 1]
-        x_train = train[:-1].reshape((-1, seq_len))
-        y_train = train[1:].reshape((-1, seq_len))
-        x_test = test[:-1].reshape((-1, seq_len))
-        y_test = test[1:].reshape((-1, seq_len))
+        self.seq_len = seq_len
+        self.random_windows = random_windows
+        # inputs and targets of every offset, targets are shifted by one token
+        self._train_windows = _windows(train[:-1], seq_len), _windows(train[1:], seq_len)
+        stride = window_stride or seq_len
+        x_train, y_train = _windows(train[:-1], seq_len, stride), _windows(train[1:], seq_len, stride)
+        x_test, y_test = _windows(test[:-1], seq_len, seq_len), _windows(test[1:], seq_len, seq_len)
         super(_CharText, self).__init__(
             name=name,
             train_data=(x_train, y_train),
@@ -596,6 +636,32 @@ class _CharText(_Dataset):
             use_embeddings=True,
             **kwargs)
 
+    def _load_tokens(self, link, file, download_dir, test_ratio):
+        prefix = os.path.splitext(file)[0]
+        if os.path.exists(prefix + ".h5") and os.path.exists(prefix + ".json"):
+            train, test = _h5_tokens(prefix + ".h5", "train"), _h5_tokens(prefix + ".h5", "test")
+            if len(test) == int(test_ratio * (len(train) + len(test))):
+                import json
+                with open(prefix + ".json") as f:
+                    return train, test, json.load(f)["token_to_idx"]
+            print("Ignoring {}.h5, it was split with a different test ratio".format(prefix))
+        self.maybe_download(link, download_dir)
+        return load_text(file, test_frac=test_ratio)
+
+    def train_batches(self, batchsize=None):
+        if not self.random_windows:
+            yield from super(_CharText, self).train_batches(batchsize)
+            return
+        if batchsize is None:
+            batchsize = self.train_batchsize
+        x, y = self._train_windows
+        num_examples = len(self.train[0])
+        # the global generator, like the shuffle of the other datasets, its state is saved by test.py checkpoints
+        offsets = np.random.randint(0, len(x), num_examples)
+        for ai in range(0, num_examples, batchsize):
+            batch = offsets[ai:ai + batchsize]
+            yield x[batch], y[batch]
+
 
 class WarAndPeace(_CharText):
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,169 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+# directory or url (file://, http://) with copies of the downloaded files, tried before the original urls
+MIRROR_ENV = "DATA_MIRROR"
+CHECKSUM_SUFFIX = ".sha256"
+PARTIAL_SUFFIX = ".part"
+LOCK_SUFFIX = ".lock"
+CHUNK_BYTES = 1 << 20
+TIMEOUT_SECS = 60
+DEFAULT_WORKERS = 4
+
+
+class _Progress(object):
+    """One progress line for all files downloaded at the same time."""
+
+    def __init__(self, files):
+        self.files = files
+        self.done = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def expect(self, size):
+        with self._lock:
+            self.total += size
+
+    def update(self, size):
+        with self._lock:
+            self.done += size
+            if self.total > 0:
+                sys.stdout.write('\rDownloading %s %.1f%%' % (self.files, min(100.0, 100.0 * self.done / self.total)))
+                sys.stdout.flush()
+
+
+def sha256sum(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_BYTES), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _read_checksum(path):
+    try:
+        with open(path + CHECKSUM_SUFFIX) as file:
+            return file.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def _write_checksum(path, checksum):
+    with open(path + CHECKSUM_SUFFIX, "w") as file:
+        file.write("{}  {}\n".format(checksum, os.path.basename(path)))
+
+
+def _is_complete(path, sha256):
+    # fetch saves the checksum of every file it downloads, a file without one may have been cut short
+    checksum = _read_checksum(path)
+    return os.path.exists(path) and checksum is not None and (sha256 is None or checksum == sha256)
+
+
+def _sources(url):
+    filename = url.split("/")[-1]
+    mirror = os.environ.get(MIRROR_ENV)
+    if mirror:
+        yield os.path.join(mirror, filename) if "://" not in mirror else mirror.rstrip("/") + "/" + filename
+    yield url
+
+
+def _copy(source, part_path, progress):
+    """Copies a local file or fetches an url into part_path, resuming a partial download with a range request."""
+    if "://" not in source:
+        progress.expect(os.path.getsize(source))
+        shutil.copyfile(source, part_path)
+        progress.update(os.path.getsize(source))
+        return
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    request = Request(source, headers={"Range": "bytes={}-".format(offset)} if offset > 0 else {})
+    try:
+        response = urlopen(request, timeout=TIMEOUT_SECS)
+    except HTTPError as e:
+        # the previous attempt got the whole file but was stopped before renaming it
+        if e.code == 416 and offset > 0:
+            return
+        raise
+    with response:
+        # servers that ignore the range send the whole file
+        if getattr(response, "status", None) != 206:
+            offset = 0
+        length = response.headers.get("Content-Length")
+        if length is not None:
+            progress.expect(offset + int(length))
+            progress.update(offset)
+        with open(part_path, "ab" if offset > 0 else "wb") as file:
+            for chunk in iter(lambda: response.read(CHUNK_BYTES), b""):
+                file.write(chunk)
+                progress.update(len(chunk))
+
+
+def _expected_checksum(source, sha256):
+    if sha256 is not None or "://" in source:
+        return sha256
+    # files copied from a mirror directory are checked against the checksum saved next to them
+    return _read_checksum(source)
+
+
+def fetch(url, download_dir, sha256=None, progress=None):
+    """Path of the file of an url in download_dir, downloaded first if it is not there yet.
+
+    The data goes to <file>.part, which a later call resumes if the download was interrupted, and is renamed to
+    <file> only once it is complete and matches the sha256 (when given). The checksum is saved in <file>.sha256,
+    so that download_dir can be used as a mirror (see MIRROR_ENV). A <file> without it (left by an interrupted
+    download of older versions) is kept only if it matches the sha256, otherwise it is downloaded again.
+    Processes and threads downloading the same file take turns on <file>.lock, the later ones find the file
+    downloaded."""
+    os.makedirs(download_dir, exist_ok=True)
+    filename = url.split("/")[-1]
+    path = os.path.join(download_dir, filename)
+    if _is_complete(path, sha256):
+        return path
+    part_path = path + PARTIAL_SUFFIX
+    progress = progress or _Progress(filename)
+    errors = []
+    with open(path + LOCK_SUFFIX, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _is_complete(path, sha256):
+            return path
+        if os.path.exists(path) and sha256 is not None and _read_checksum(path) is None and sha256sum(path) == sha256:
+            _write_checksum(path, sha256)
+            return path
+        for source in _sources(url):
+            try:
+                _copy(source, part_path, progress)
+            except OSError as e:
+                errors.append("{}: {}".format(source, e))
+                continue
+            checksum = sha256sum(part_path)
+            expected = _expected_checksum(source, sha256)
+            if expected is not None and checksum != expected:
+                os.remove(part_path)
+                errors.append("{}: checksum mismatch {} != {}".format(source, checksum, expected))
+                continue
+            _write_checksum(path, checksum)
+            os.replace(part_path, path)
+            return path
+    raise OSError("Failed to download {}:\n  {}".format(filename, "\n  ".join(errors)))
+
+
+def fetch_all(urls, download_dir, workers=DEFAULT_WORKERS, checksums=None):
+    """Paths of the files of the urls, the missing ones downloaded concurrently.
+    checksums: {filename: sha256} of the files that are known."""
+    checksums = checksums or {}
+    missing = [url for url in urls
+               if not _is_complete(os.path.join(download_dir, url.split("/")[-1]), checksums.get(url.split("/")[-1]))]
+    if len(missing) > 0:
+        progress = _Progress(", ".join(url.split("/")[-1] for url in missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda url: fetch(url, download_dir, checksums.get(url.split("/")[-1]), progress),
+                              missing))
+        print()
+        print('Successfully downloaded', progress.files, progress.done, 'bytes.')
+    return [os.path.join(download_dir, url.split("/")[-1]) for url in urls]
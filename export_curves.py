@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+from util_plot import *
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import csv
+import numpy as np
+
+
+def column_name(algo):
+    """Column header in the style of artificial_new.csv, e.g. "adam_l0.01" -> "adam (l0.01)"."""
+    family, args = algo_family(algo), algo_args(algo)
+    if args == "":
+        return family
+    return "{} ({})".format(family, args)
+
+
+def aggregate(tree, every, mode="test"):
+    """Mean (and std) of every run group interpolated on a common grid of steps (every `every` steps)."""
+    keys = sorted(key for key in tree.random_access_data if key[1] == mode)
+    if len(keys) == 0:
+        raise ValueError("No {} runs match the filters and excludes".format(mode))
+    datasets = {key[0] for key in keys}
+    architectures = {key[2] for key in keys}
+    last_step = max([tree.get(key).steps[-1] for key in keys if len(tree.get(key).steps) > 0] + [0])
+    grid = np.arange(every, last_step + 1, every)
+    if len(grid) == 0:
+        raise ValueError("The {} runs end before step {} (--every)".format(mode, every))
+
+    names = []
+    means = []
+    stds = []
+    for key in keys:
+        dataset, _, architecture, algo = key
+        stats = tree.get(key)
+        name = column_name(algo)
+        if len(architectures) > 1:
+            name = "{}/{}".format(architecture, name)
+        if len(datasets) > 1:
+            name = "{}/{}".format(dataset, name)
+        names.append(name)
+        # nan outside of the steps a run group covers
+        means.append(np.interp(grid, stats.steps, stats.mean, left=np.nan, right=np.nan))
+        stds.append(np.interp(grid, stats.steps, stats.std, left=np.nan, right=np.nan))
+    return grid, names, np.array(means).reshape((-1, len(grid))).T, np.array(stds).reshape((-1, len(grid))).T
+
+
+def write_csv(path, grid, names, means, stds=None):
+    header = ["t"] + names
+    if stds is not None:
+        header += [name + " std" for name in names]
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for i, step in enumerate(grid):
+            row = [step] + list(means[i])
+            if stds is not None:
+                row += list(stds[i])
+            writer.writerow(row)
+
+
+def write_npz(path, grid, names, means, stds=None):
+    arrays = {"t": grid, "names": np.array(names), "mean": means.astype(np.float32)}
+    if stds is not None:
+        arrays["std"] = stds.astype(np.float32)
+    np.savez_compressed(path, **arrays)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Exports learning curves aggregated across repeated runs, "
+                                        "one column per optimizer configuration (like artificial_new.csv).",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--log_dir",
+                        default="tb_logs_linear")
+    parser.add_argument("-o", "--output",
+                        default="curves.csv",
+                        help="output file, .csv or .npz")
+    parser.add_argument("--key", "-k", default="cross_entropy")
+    parser.add_argument("--mode", default="test", choices=("test", "train"))
+    parser.add_argument("--every", type=int, default=50,
+                        help="distance between exported steps")
+    parser.add_argument("--std", default=False, action="store_true",
+                        help="export std across runs next to the means")
+    parser.add_argument("-f", "--filters",
+                        nargs="*",
+                        default=[],
+                        help="only runs with a path token starting with any of these")
+    parser.add_argument("-x", "--exclude",
+                        nargs="*",
+                        default=[],
+                        help="skip runs with a path token containing any of these")
+    parser.add_argument("--verbose", "-v",
+                        action="store_true",
+                        default=False)
+    args = parser.parse_args()
+
+    # runs are folded into per-step statistics while they are read
+    tree = Tree(key=args.key, verbose=args.verbose, streaming=True)
+    tree.load(args.log_dir, args.filters, args.exclude)
+
+    try:
+        grid, names, means, stds = aggregate(tree, args.every, mode=args.mode)
+    except ValueError as e:
+        print("{} in '{}', nothing to export.".format(e, args.log_dir))
+        exit(1)
+    if not args.std:
+        stds = None
+    if args.output.endswith(".npz"):
+        write_npz(args.output, grid, names, means, stds)
+    else:
+        write_csv(args.output, grid, names, means, stds)
+    print("Exported {} curves x {} steps to: '{}'".format(len(names), len(grid), args.output))
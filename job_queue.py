@@ -0,0 +1,99 @@
+import json
+import os
+import socket
+import threading
+import time
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+HEARTBEAT_SECS = 30
+DEFAULT_STALE_SECS = 300
+
+
+class JobQueue(object):
+    """Job queue in a (shared) directory, one json file per job moving between pending/, running/, done/ and
+    failed/. Jobs are claimed by renaming them, which is atomic, so any number of workers on any number of
+    nodes can take jobs from the same directory. A worker touches the file of its job periodically, jobs of
+    workers that stopped doing so are put back to pending/."""
+
+    def __init__(self, root):
+        self.root = root
+        for state in (PENDING, RUNNING, DONE, FAILED):
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _path(self, state, name):
+        return os.path.join(self.root, state, name)
+
+    def _list(self, state):
+        return sorted(name for name in os.listdir(os.path.join(self.root, state)) if name.endswith(".json"))
+
+    def enqueue(self, jobs):
+        # names sort in the order of enqueueing
+        stamp = time.strftime("%Y%m%d%H%M%S")
+        for i, job in enumerate(jobs):
+            name = "{}_{:06d}_{}.json".format(stamp, i, os.getpid())
+            tmp_path = os.path.join(self.root, "." + name)
+            with open(tmp_path, "w") as file:
+                json.dump(job, file)
+            os.rename(tmp_path, self._path(PENDING, name))
+        return len(jobs)
+
+    def claim(self):
+        """(name, job) of a pending job now owned by the caller, None if there are none left."""
+        for name in self._list(PENDING):
+            try:
+                os.rename(self._path(PENDING, name), self._path(RUNNING, name))
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            os.utime(self._path(RUNNING, name))
+            with open(self._path(RUNNING, name)) as file:
+                return name, json.load(file)
+        return None
+
+    def finish(self, name, job, failed=False):
+        job = dict(job, worker=worker_name())
+        path = self._path(RUNNING, name)
+        try:
+            with open(path + ".tmp", "w") as file:
+                json.dump(job, file)
+            os.replace(path + ".tmp", path)
+            os.rename(path, self._path(FAILED if failed else DONE, name))
+        except FileNotFoundError:
+            print("Job '{}' was requeued while it was running (missed heartbeats?)".format(name))
+
+    def requeue_stale(self, stale_secs=DEFAULT_STALE_SECS):
+        requeued = 0
+        now = time.time()
+        for name in self._list(RUNNING):
+            try:
+                if now - os.path.getmtime(self._path(RUNNING, name)) > stale_secs:
+                    os.rename(self._path(RUNNING, name), self._path(PENDING, name))
+                    requeued += 1
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def counts(self):
+        return {state: len(self._list(state)) for state in (PENDING, RUNNING, DONE, FAILED)}
+
+    def heartbeat(self, name, every=HEARTBEAT_SECS):
+        """Starts touching the file of a running job in a background thread, returns the event that stops it."""
+        stop = threading.Event()
+        path = self._path(RUNNING, name)
+
+        def beat():
+            while not stop.wait(every):
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    return
+
+        threading.Thread(target=beat, daemon=True).start()
+        return stop
+
+
+def worker_name():
+    return "{}_{}".format(socket.gethostname(), os.getpid())
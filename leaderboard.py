@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+from util_plot import *
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import json
+import numpy as np
+
+METRICS = ("cross_entropy", "accuracy")
+HIGHER_IS_BETTER = ("accuracy",)
+SUMMARIES = ("final", "best", "auc")
+
+
+def _summaries(steps, values, higher_is_better=False):
+    # values: [runs, steps], every statistic is computed for all runs at once
+    final = values[:, -1]
+    best = values.max(1) if higher_is_better else values.min(1)
+    # area under the curve normalized by its length, i.e. the average level of the curve
+    auc = np.trapz(values, steps, axis=1) / max(steps[-1] - steps[0], 1)
+    return {"final": final, "best": best, "auc": auc}
+
+
+def collect(log_dir, mode="test", filters=None, excludes=None, verbose=False):
+    """Final, best and area-under-curve of every metric for each (dataset, model, optimizer, args)
+    group of runs, as mean and std across repeated runs."""
+    tree = Tree(verbose=verbose)
+    sources = tree.find_runs(log_dir, filters, excludes)
+    rows = []
+    for (dataset, run_mode, architecture, algo), files in sorted(sources.items()):
+        if run_mode != mode:
+            continue
+        runs = [read_scalars(filename, METRICS) for filename in files]
+        row = {"dataset": dataset,
+               "architecture": architecture,
+               "algo": algo,
+               "family": algo_family(algo),
+               "runs": len(runs),
+               "diverged": sum(is_diverged(filename) for filename in files)}
+        for metric in METRICS:
+            # the first point is the evaluation before training, same as in Tree
+            series = [(steps[1:], values[metric][1:]) for steps, values in runs if len(values[metric]) > 1]
+            if len(series) == 0:
+                continue
+            length = min(len(values) for _, values in series)
+            steps = np.array(series[0][0][0:length], dtype=np.float64)
+            values = np.array([values[0:length] for _, values in series], dtype=np.float64)
+            for name, summary in _summaries(steps, values, metric in HIGHER_IS_BETTER).items():
+                if row["diverged"] > 0:
+                    # curves of aborted runs are truncated, the configuration is ranked last
+                    summary = np.full_like(summary, np.nan)
+                row["{}_{}_mean".format(metric, name)] = summary.mean()
+                row["{}_{}_std".format(metric, name)] = summary.std()
+        rows.append(row)
+    return rows
+
+
+def best_configs(rows, key="cross_entropy", rank_by="final"):
+    """Best run name of every optimizer family: {dataset: {architecture: {family: algo}}}."""
+    column = "{}_{}_mean".format(key, rank_by)
+    sign = -1 if key in HIGHER_IS_BETTER else 1
+    best = {}
+    scores = {}
+    for row in rows:
+        if column not in row:
+            continue
+        score = sign * row[column]
+        if np.isnan(score):
+            score = np.inf
+        group = row["dataset"], row["architecture"], row["family"]
+        if group not in scores or score < scores[group]:
+            scores[group] = score
+            best.setdefault(row["dataset"], {}).setdefault(row["architecture"], {})[row["family"]] = row["algo"]
+    return best
+
+
+def cached_best_configs(log_dir, sources, cache, filters=None, excludes=None):
+    """best_configs of the test logs, read again only when one of the test event files in sources (from
+    Tree.find_runs) changed since it was stored in the BuildCache."""
+    files = [filename for (dataset, mode, architecture, algo), filenames in sources.items() if mode == "test"
+             for filename in filenames]
+    signature = cache.signature(files, {"log_dir": log_dir, "filters": filters, "excludes": excludes})
+    best = cache.lookup("best_configs", signature)
+    if best is None:
+        best = best_configs(collect(log_dir, filters=filters, excludes=excludes))
+        cache.store("best_configs", signature, best)
+    return best
+
+
+def load_best_configs(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def best_runs_sets(best):
+    """{(dataset, architecture): set of run names} as used for the joined plots."""
+    return {(dataset, architecture): set(families.values())
+            for dataset, architectures in best.items()
+            for architecture, families in architectures.items()}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Ranks hyperparameters of every optimizer by their test metrics.",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--log_dir",
+                        default="tb_logs_linear")
+    parser.add_argument("--mode", default="test", choices=("test", "train"))
+    parser.add_argument("--key", "-k", default="cross_entropy", choices=METRICS,
+                        help="metric the configurations are ranked by")
+    parser.add_argument("--rank-by", default="final", choices=SUMMARIES)
+    parser.add_argument("--all", "-a", default=False, action="store_true",
+                        help="list every configuration, not only the best of each optimizer family")
+    parser.add_argument("-o", "--output",
+                        default=None,
+                        help="json file with the best configurations (consumed by plot_linear.py --best-runs)")
+    parser.add_argument("--verbose", "-v",
+                        action="store_true",
+                        default=False)
+    args = parser.parse_args()
+
+    rows = collect(args.log_dir, mode=args.mode, verbose=args.verbose)
+    best = best_configs(rows, key=args.key, rank_by=args.rank_by)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(best, file, indent=2, sort_keys=True)
+        print("Best configurations saved to: '{}'".format(args.output))
+
+    if not args.all:
+        selected = {(dataset, architecture, algo)
+                    for dataset, architectures in best.items()
+                    for architecture, families in architectures.items()
+                    for algo in families.values()}
+        rows = [row for row in rows if (row["dataset"], row["architecture"], row["algo"]) in selected]
+
+    header = ["dataset", "model", "algo", "runs", "diverged"]
+    columns = ["{}_{}".format(metric, summary) for metric in METRICS for summary in SUMMARIES]
+    lines = []
+    for row in rows:
+        line = [row["dataset"], row["architecture"], row["algo"], row["runs"], row["diverged"]]
+        for column in columns:
+            if column + "_mean" in row:
+                line.append("{:.4f} ± {:.4f}".format(row[column + "_mean"], row[column + "_std"]))
+            else:
+                line.append("-")
+        lines.append(line)
+    import tabulate
+
+    print(tabulate.tabulate(lines, header + columns))
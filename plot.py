@@ -227,7 +227,7 @@ if __name__ == "__main__":
                         default="tb_logs")
     parser.add_argument("-i", "--interactive",
                         action="store_true",
-                        help="TODO")
+                        help="browse the runs in a local dashboard (see dashboard.py)")
     parser.add_argument("-f", "--filters",
                         nargs="*",
                         default=[],
@@ -245,6 +245,12 @@ if __name__ == "__main__":
                         default=False)
     args = parser.parse_args()
 
+    if args.interactive:
+        from dashboard import serve
+
+        serve(args.log_dir, verbose=args.verbose)
+        exit(0)
+
     all_files = glob.glob('{}/**/*events*'.format(args.log_dir), recursive=True)
     tree = Tree(verbose=args.verbose)
 
@@ -253,8 +259,6 @@ if __name__ == "__main__":
     if args.list:
         tree.print()
         exit(0)
-    if args.interactive:
-        raise NotImplementedError()
 
     # Plot everything separately
     all_keys = list(tree.random_access_data.keys())
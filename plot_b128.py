@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from util_plot import *
+from leaderboard import best_runs_sets, cached_best_configs, load_best_configs
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 import warnings
 from collections import defaultdict
@@ -79,6 +80,12 @@ markers_dict = {
 
 }
 
+def _group_name(algo):
+    for group_name in sorted(names_dict, reverse=True):
+        if algo.startswith(group_name):
+            return group_name
+
+
 def plot_with_std(tree,
                   tag_sets,
                   title="TODO",
@@ -86,7 +93,17 @@ def plot_with_std(tree,
                   verbose=False,
                   x_axis_label="# minibatches",
                   line=None,
+                  max_points=None,
+                  downsample="lttb",
+                  ax=None,
                   **kwargs):
+    if tree.streaming:
+        ax = _plot_running_stats(tree, tag_sets, y_axis=y_axis, line=line,
+                                 max_points=max_points, downsample=downsample, ax=ax, **kwargs)
+        ax.set_title(title)
+        ax.set_xlabel(x_axis_label)
+        return ax
+
     data = []
     steps = None
     min_runs_num = np.inf
@@ -120,14 +137,7 @@ def plot_with_std(tree,
         data = data[0]
         data = data.reshape(list(data.shape) + [1])
 
-    short_names = [t[-1] for t in tag_sets]
-    new_short_names = []
-    for name in short_names:
-        for group_name in sorted(names_dict, reverse=True):
-            if name.startswith(group_name):
-                new_short_names.append(group_name)
-                break
-    short_names = new_short_names
+    short_names = [_group_name(t[-1]) for t in tag_sets]
 
     default_kwargs = {
         "err_style": "ci_band",
@@ -138,11 +148,12 @@ def plot_with_std(tree,
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=UserWarning)
         warnings.filterwarnings("ignore", category=FutureWarning)
-        ax = None
         for di in range(data.shape[2]):
             sn = short_names[di]
-            ax = sns.tsplot(data[:, :, di],
-                            time=steps,
+            # same points for every run, so the std band matches the unreduced one
+            indices = downsample_indices(steps, data[:, :, di].mean(0), max_points, downsample)
+            ax = sns.tsplot(data[:, indices, di],
+                            time=steps[indices],
                             value=y_axis,
                             condition=names_dict[sn],
                             legend=len(data.shape) > 2,
@@ -159,8 +170,31 @@ def plot_with_std(tree,
             sns.tsplot([line] * len(steps),
                        color=black, time=steps, linewidth=1, linestyle='--', ax=ax,
                        )
-    plt.title(title)
-    plt.xlabel(x_axis_label)
+    ax.set_title(title)
+    ax.set_xlabel(x_axis_label)
+    return ax
+
+
+def _plot_running_stats(tree, tag_sets, y_axis, line=None, err_style="ci_band", max_points=None,
+                        downsample="lttb", ax=None, **kwargs):
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        for tags in tag_sets:
+            sn = _group_name(tags[-1])
+            ax = plot_running_stats(tree.get(tags),
+                                    condition=names_dict[sn],
+                                    value=y_axis,
+                                    color=colors_dict[sn],
+                                    marker=markers_dict[sn],
+                                    err_style=err_style,
+                                    max_points=max_points,
+                                    downsample=downsample,
+                                    ax=ax)
+            set_ax_props(ax)
+
+        if line is not None:
+            ax.axhline(line, color=black, linewidth=1, linestyle='--')
+    return ax
 
 
 def plot_with_std_v2(tree,
@@ -235,6 +269,42 @@ def plot_with_std_v2(tree,
     plt.xlabel(x_axis_label)
 
 
+BUILD_CACHE_FILE = ".build_cache.json"
+
+
+def draw_figure(job, shared, ax=None):
+    args = shared["args"]
+    ax = plot_with_std(shared["tree"],
+                       tag_sets=job["tag_sets"],
+                       y_axis="cross entropy",
+                       title=job["title"],
+                       max_points=args.max_points,
+                       downsample=args.downsample,
+                       ax=ax,
+                       **job["kwargs"])
+    if args.log_scale:
+        ax.set_yscale("log")
+    return ax
+
+
+def render_figure(job, shared):
+    args = shared["args"]
+    fig, ax = new_figure()
+    try:
+        draw_figure(job, shared, ax)
+        save_plot(job["path"], extension=args.extension, fig=fig)
+        return True
+    except Exception as ex:
+        print("Failed for: {}".format(job["path"]))
+        if args.verbose:
+            print(" ============== EXCEPTION ============")
+            print(ex)
+            traceback.print_exc()
+            print(" =====================================")
+            print()
+        return False
+
+
 if __name__ == "__main__":
     parser = ArgumentParser("Plots multiple runs of benchmark algorithms.",
                             formatter_class=ArgumentDefaultsHelpFormatter)
@@ -254,130 +324,100 @@ if __name__ == "__main__":
     parser.add_argument("--show", "-s", default=False, action="store_true")
 
     parser.add_argument("--log-scale", "-log", default=False, action="store_true")
+    parser.add_argument("--streaming", default=False, action="store_true",
+                        help="aggregate repeated runs into per-step mean/std while loading them")
+    parser.add_argument("--max-points", type=int, default=1000,
+                        help="maximal number of points drawn per curve (0 draws all of them)")
+    parser.add_argument("--downsample", default="lttb", choices=tuple(DOWNSAMPLERS))
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="number of processes rendering figures (all cores by default)")
+    parser.add_argument("--best-runs", default=None,
+                        help="json with the best configuration of every optimizer (see leaderboard.py), "
+                             "computed from the test logs if not given")
+    parser.add_argument("--force", "-f", default=False, action="store_true",
+                        help="render every figure, even if its runs and parameters did not change")
     args = parser.parse_args()
 
-
-
-
-
-    tree = Tree(verbose=args.verbose)
+    tree = Tree(verbose=args.verbose, streaming=args.streaming)
 
     filters = ["scinol2", "cocob", "adam", "adagrad", "adadelta", "rmsprop", "sgd"]
     excludes = ["prescinol2"]
-    tree.load(args.log_dir, filters, excludes)
-
     if args.list:
+        tree.load(args.log_dir, filters, excludes)
         tree.print()
         exit(0)
+    tree.find_runs(args.log_dir, filters, excludes)
 
-
-    all_keys = list(tree.random_access_data.keys())
+    all_keys = list(tree.sources.keys())
+    log_suffix = "_log" if args.log_scale else ""
 
     # Plots everything separately
-    print("Plotting separate graphs. Saving to: '{}'".format(args.output_dir))
+    jobs = []
     if not args.show:
-        for key in tqdm(all_keys, leave=False):
+        for key in all_keys:
             dataset, mode, architecture, algo = key
-            try:
-                plot_with_std(tree,
-                              tag_sets=[key],
-                              y_axis="cross entropy",
-                              title="{}: {}".format(dataset, algo),
-                              err_style="unit_traces",
-                              )
-                path = os.path.join(args.output_dir, dataset, algo)
-                if args.log_scale:
-                    plt.yscale("log")
-                    path += "_log"
-                save_plot(path, extension=args.extension)
-            except Exception as ex:
-                print("Failed for: {}".format(key))
-                print("Data shape: {}".format(tree.get(key).shape))
-                if args.verbose:
-                    print(" ============== EXCEPTION ============")
-                    print(ex)
-                    traceback.print_exc()
-                    print(" =====================================")
-                    print()
+            jobs.append({"path": os.path.join(args.output_dir, dataset, algo) + log_suffix,
+                         "title": "{}: {}".format(dataset, algo),
+                         "tag_sets": [key],
+                         "kwargs": {"err_style": "unit_traces"}})
 
     # Plot version 1
-    print("Plotting joined graphs.")
     joined_keys = {}
     for d, m, a, algo in all_keys:
         if not (d, m, a) in joined_keys:
             joined_keys[(d, m, a)] = []
         joined_keys[(d, m, a)].append([d, m, a, algo])
 
-    best_runs = {
-        "mnist":
-            {"adagrad_l0.1",
-             "adadelta_l1.0",
-             "rmsprop_l0.0005",
-             "adam_l0.0001",
-             "sgd_l1.0"},
-        "UCI_Covertype":
-            {"adagrad_l0.005",
-             "adadelta_l0.1",
-             "rmsprop_l1e-05",
-             "adam_l0.0001",
-             "sgd_l0.0001"},
-        "UCI_Census":
-            {"adagrad_l0.001",
-             "adadelta_l0.5",
-             "adam_l0.0001",
-             "rmsprop_l1e-05",
-             "sgd_l0.0001"},
-        "UCI_Madelon":
-            {"adagrad_l1e-05",
-             "adadelta_l0.0005",
-             "rmsprop_l0.0001",
-             "adam_l0.0001",
-             "sgd_l1.0"},
-        "UCI_Bank":
-            {"adagrad_l0.01",
-             "adadelta_l0.1",
-             "adam_l0.0005",
-             "rmsprop_l0.0001",
-             "sgd_l1e-05"},
-        "Penn_shuttle":
-            {"adagrad_l0.01",
-             "adadelta_l0.5",
-             "adam_l0.0001",
-             "rmsprop_l0.0001",
-             "sgd_l0.005"}
-    }
-    for best_set in best_runs.values():
-        best_set.add("scinol2")
-        best_set.add("cocob")
+    # Only figures whose runs or parameters changed since the last invocation are rendered
+    cache = BuildCache(os.path.join(args.output_dir, BUILD_CACHE_FILE))
+    if args.best_runs is not None:
+        best_runs = best_runs_sets(load_best_configs(args.best_runs))
+    else:
+        best_runs = best_runs_sets(cached_best_configs(args.log_dir, tree.sources, cache, filters, excludes))
 
-    for [d, m, a], tag_set in tqdm(joined_keys.items(), leave=False):
+    joined_jobs = []
+    for [d, m, a], tag_set in joined_keys.items():
         new_tag_set = []
         for tags in tag_set:
-            if tags[-1] in best_runs[d]:
+            if tags[-1] in best_runs.get((d, a), ()):
                 new_tag_set.append(tags)
+        if len(new_tag_set) == 0:
+            continue
         tag_set = sorted(new_tag_set, key=lambda x: x[3])
-        plot_with_std(tree,
-                      tag_sets=tag_set,
-                      y_axis="cross entropy",
-                      title=titles_dict[d],
-                      line=None
-                      )
-        path = os.path.join(args.output_dir, d)
-        if args.log_scale:
-            plt.yscale("log")
-            path += "_log"
-
-        if args.show:
-            plt.show()
-        else:
-            save_plot(path, extension=args.extension)
-
-            # # Plot version 2
-            # for [d, m, a], tag_set in tqdm(joined_keys.items(), leave=False):
-            #     tag_set = sorted(tag_set, key=lambda x: x[3])
-            #     plot_with_std_v2(tree,
-            #                      tag_sets=tag_set,
-            #                      y_axis="cross entropy",
-            #                      title=titles_dict[d])
-            #     save_plot(os.path.join(args.output_dir, "all_v2", d) + "_v2",
-            #               extension=args.extension)
+        joined_jobs.append({"path": os.path.join(args.output_dir, d) + log_suffix,
+                            "title": titles_dict[d],
+                            "tag_sets": tag_set,
+                            "kwargs": {"line": None}})
+
+    params = {name: getattr(args, name) for name in ("extension", "log_scale", "streaming",
+                                                     "max_points", "downsample")}
+    if not args.show:
+        jobs += joined_jobs
+        joined_jobs = []
+    total_jobs = len(jobs)
+    jobs = stale_jobs(jobs, tree, cache, params, force=args.force)
+    tree.load(args.log_dir, filters, excludes, keys=job_keys(jobs + joined_jobs))
+
+    shared = {"args": args, "tree": tree}
+    print("Plotting {} graphs ({} up to date). Saving to: '{}'".format(len(jobs),
+                                                                      total_jobs - len(jobs),
+                                                                      args.output_dir))
+    rendered = render_jobs(render_figure, jobs, shared, processes=args.jobs)
+    for job, success in zip(jobs, rendered):
+        if success:
+            cache.update(job["output"], job["signature"])
+    cache.save()
+
+    for job in joined_jobs:
+        draw_figure(job, shared, plt.figure().gca())
+        plt.show()
+
+    # # Plot version 2
+    # for [d, m, a], tag_set in tqdm(joined_keys.items(), leave=False):
+    #     tag_set = sorted(tag_set, key=lambda x: x[3])
+    #     plot_with_std_v2(tree,
+    #                      tag_sets=tag_set,
+    #                      y_axis="cross entropy",
+    #                      title=titles_dict[d])
+    #     save_plot(os.path.join(args.output_dir, "all_v2", d) + "_v2",
+    #               extension=args.extension)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from util_plot import *
+from leaderboard import best_runs_sets, cached_best_configs, load_best_configs
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 import warnings
 from collections import defaultdict
@@ -59,7 +60,7 @@ file_suffixes = {"cross_entropy": "ce", "accuracy": "acc"}
 
 
 def set_ax_props(ax):
-    plt.grid(color=light_gray, which="both")
+    ax.grid(color=light_gray, which="both")
     # ax.set_facecolor(white)
 
 
@@ -118,6 +119,12 @@ markers_dict = {
 }
 
 
+def _group_name(algo):
+    for group_name in sorted(names_dict, reverse=True):
+        if algo.startswith(group_name):
+            return group_name
+
+
 def plot_with_std(tree,
                   tag_sets,
                   title="TODO",
@@ -125,7 +132,17 @@ def plot_with_std(tree,
                   verbose=False,
                   x_axis_label="# iterations",
                   line=None,
+                  max_points=None,
+                  downsample="lttb",
+                  ax=None,
                   **kwargs):
+    if tree.streaming:
+        ax = _plot_running_stats(tree, tag_sets, y_axis=y_axis, line=line,
+                                 max_points=max_points, downsample=downsample, ax=ax, **kwargs)
+        ax.set_title(title)
+        ax.set_xlabel(x_axis_label)
+        return ax
+
     data = []
     steps = None
     min_runs_num = np.inf
@@ -159,14 +176,7 @@ def plot_with_std(tree,
         data = data[0]
         data = data.reshape(list(data.shape) + [1])
 
-    short_names = [t[-1] for t in tag_sets]
-    new_short_names = []
-    for name in short_names:
-        for group_name in sorted(names_dict, reverse=True):
-            if name.startswith(group_name):
-                new_short_names.append(group_name)
-                break
-    short_names = new_short_names
+    short_names = [_group_name(t[-1]) for t in tag_sets]
 
     default_kwargs = {
         "err_style": "ci_band",
@@ -177,11 +187,12 @@ def plot_with_std(tree,
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=UserWarning)
         warnings.filterwarnings("ignore", category=FutureWarning)
-        ax = None
         for di in range(data.shape[2]):
             sn = short_names[di]
-            ax = sns.tsplot(data[:, :, di],
-                            time=steps,
+            # same points for every run, so the std band matches the unreduced one
+            indices = downsample_indices(steps, data[:, :, di].mean(0), max_points, downsample)
+            ax = sns.tsplot(data[:, indices, di],
+                            time=steps[indices],
                             value=y_axis,
                             condition=names_dict[sn],
                             legend=len(data.shape) > 2,
@@ -198,8 +209,31 @@ def plot_with_std(tree,
             sns.tsplot([line] * len(steps),
                        color=black, time=steps, linewidth=1, linestyle='--', ax=ax,
                        )
-    plt.title(title)
-    plt.xlabel(x_axis_label)
+    ax.set_title(title)
+    ax.set_xlabel(x_axis_label)
+    return ax
+
+
+def _plot_running_stats(tree, tag_sets, y_axis, line=None, err_style="ci_band", max_points=None,
+                        downsample="lttb", ax=None, **kwargs):
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        for tags in tag_sets:
+            sn = _group_name(tags[-1])
+            ax = plot_running_stats(tree.get(tags),
+                                    condition=names_dict[sn],
+                                    value=y_axis,
+                                    color=colors_dict[sn],
+                                    marker=markers_dict[sn],
+                                    err_style=err_style,
+                                    max_points=max_points,
+                                    downsample=downsample,
+                                    ax=ax)
+            set_ax_props(ax)
+
+        if line is not None:
+            ax.axhline(line, color=black, linewidth=1, linestyle='--')
+    return ax
 
 
 def plot_with_std_v2(tree,
@@ -274,6 +308,95 @@ def plot_with_std_v2(tree,
     plt.xlabel(x_axis_label)
 
 
+START_ENTROPY = np.log(2)
+BEST_ENTROPY = 0.26
+ARTIFICIAL_CSV = "artificial_new.csv"
+BUILD_CACHE_FILE = ".build_cache.json"
+
+
+def load_artificial(path=ARTIFICIAL_CSV):
+    df = pd.read_csv(path)
+    header = df.columns.values[1:48]
+    data = df.values[:, 1:48]
+    t = df.values[:, 0]
+    t = np.append(t, [0])
+    runs = defaultdict(list)
+    for h, y in zip(header, data.T):
+        name = h.split(" ")[0]
+        y = np.append(y, [START_ENTROPY])
+        runs[name].append(y)
+    return runs, t
+
+
+def plot_artificial(runs, t, ax=None):
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        for name in runs:
+            for i, run in enumerate(runs[name]):
+                ax = sns.tsplot(run,
+                                condition=names_dict[name],
+                                color=colors_dict[name],
+                                time=t,
+                                markersize=4,
+                                linewidth=1 / len(runs[name]),
+                                legend=(i == 0),
+                                value=axis_labels["cross_entropy"],
+                                ax=ax,
+                                )
+        ax = sns.tsplot([BEST_ENTROPY] * len(t),
+                        color=black, time=t, linewidth=1, linestyle='--', ax=ax,
+                        )
+        sns.tsplot([START_ENTROPY] * len(t),
+                   color=black, time=t, linewidth=1, linestyle='--', ax=ax,
+                   )
+        set_ax_props(ax)
+        ax.set_xlabel("# iterations")
+    return ax
+
+
+def draw_figure(job, shared, ax=None):
+    args = shared["args"]
+    if job["kind"] == "artificial":
+        ax = plot_artificial(shared["runs"], shared["t"], ax=ax)
+        if job["zoom"]:
+            ax.set_ylim(BEST_ENTROPY, START_ENTROPY)
+        else:
+            ax.set_yscale("log")
+        ax.set_title(job["title"])
+    else:
+        ax = plot_with_std(shared["tree"],
+                           tag_sets=job["tag_sets"],
+                           y_axis=axis_labels[args.key],
+                           title=job["title"],
+                           max_points=args.max_points,
+                           downsample=args.downsample,
+                           ax=ax,
+                           **job["kwargs"])
+        if args.log_scale:
+            ax.set_yscale("log")
+    return ax
+
+
+def render_figure(job, shared):
+    args = shared["args"]
+    fig, ax = new_figure()
+    try:
+        draw_figure(job, shared, ax)
+        logscale = job["kind"] == "artificial" and not job["zoom"]
+        save_plot(job["path"], extension=args.extension, logscale=logscale, verbose=args.verbose, fig=fig)
+        return True
+    except Exception as ex:
+        print("Failed for: {}".format(job["path"]))
+        if args.verbose:
+            print(" ============== EXCEPTION ============")
+            print(ex)
+            traceback.print_exc()
+            print(" =====================================")
+            print()
+        return False
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(description="Plots multiple runs of benchmark algorithms.",
                             formatter_class=ArgumentDefaultsHelpFormatter)
@@ -293,181 +416,118 @@ if __name__ == "__main__":
     parser.add_argument("--show", "-s", default=False, action="store_true")
 
     parser.add_argument("--log-scale", "-log", default=False, action="store_true")
+    parser.add_argument("--streaming", default=False, action="store_true",
+                        help="aggregate repeated runs into per-step mean/std while loading them")
+    parser.add_argument("--max-points", type=int, default=1000,
+                        help="maximal number of points drawn per curve (0 draws all of them)")
+    parser.add_argument("--downsample", default="lttb", choices=tuple(DOWNSAMPLERS))
     parser.add_argument("--key", "-k", default="cross_entropy", choices=tuple(file_suffixes))
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+                        help="number of processes rendering figures (all cores by default)")
+    parser.add_argument("--best-runs", default=None,
+                        help="json with the best configuration of every optimizer (see leaderboard.py), "
+                             "computed from the test logs if not given")
+    parser.add_argument("--force", "-f", default=False, action="store_true",
+                        help="render every figure, even if its runs and parameters did not change")
     args = parser.parse_args()
 
-    # artificial exp :
-    df = pd.read_csv("artificial_new.csv")
-    header = df.columns.values[1:48]
-    data = df.values[:, 1:48]
-    t = df.values[:, 0]
-    t = np.append(t, [0])
-    START_ENTROPY = np.log(2)
-    BEST_ENTROPY = 0.26
-    runs = defaultdict(list)
-    for h, y in zip(header, data.T):
-        name = h.split(" ")[0]
-        y = np.append(y, [START_ENTROPY])
-        runs[name].append(y)
-
-
-    def plot():
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=UserWarning)
-            warnings.filterwarnings("ignore", category=FutureWarning)
-            ax = None
-            for name in runs:
-                for i, run in enumerate(runs[name]):
-                    ax = sns.tsplot(run,
-                                    condition=names_dict[name],
-                                    color=colors_dict[name],
-                                    time=t,
-                                    markersize=4,
-                                    linewidth=1 / len(runs[name]),
-                                    legend=(i == 0),
-                                    value=axis_labels["cross_entropy"],
-                                    ax=ax,
-                                    )
-            ax = sns.tsplot([BEST_ENTROPY] * len(t),
-                            color=black, time=t, linewidth=1, linestyle='--', ax=ax,
-                            )
-            sns.tsplot([START_ENTROPY] * len(t),
-                       color=black, time=t, linewidth=1, linestyle='--', ax=ax,
-                       )
-            set_ax_props(ax)
-            plt.xlabel("# iterations")
-            plt.xlabel("# iterations")
-
-
-    tree = Tree(key=args.key, verbose=args.verbose)
+    tree = Tree(key=args.key, verbose=args.verbose, streaming=args.streaming)
 
     filters = ["scinol", "scinol2", "cocob", "adam", "adagrad", "nag", "sgd", "prescinol_edt", ]
 
     excludes = []
-    tree.load(args.log_dir, filters, excludes)
-
     if args.list:
+        tree.load(args.log_dir, filters, excludes)
         tree.print()
         exit(0)
+    tree.find_runs(args.log_dir, filters, excludes)
 
-    print("Plotting artificial experiment...")
-    plot()
-    plt.yscale("log")
-    plt.title("Artificial data")
-    path = os.path.join(args.output_dir, "artificial")
-    save_plot(path, extension=args.extension, logscale=True, verbose=args.verbose)
-
-    plot()
-    plt.title("Artificial data (zoom)")
-    plt.ylim(BEST_ENTROPY, START_ENTROPY)
-    path = os.path.join(args.output_dir, "artificial_zoom")
-    save_plot(path, extension=args.extension, verbose=args.verbose)
-
-    all_keys = list(tree.random_access_data.keys())
+    # artificial exp :
+    jobs = [
+        {"kind": "artificial",
+         "path": os.path.join(args.output_dir, "artificial"),
+         "title": "Artificial data",
+         "zoom": False,
+         "files": [ARTIFICIAL_CSV]},
+        {"kind": "artificial",
+         "path": os.path.join(args.output_dir, "artificial_zoom"),
+         "title": "Artificial data (zoom)",
+         "zoom": True,
+         "files": [ARTIFICIAL_CSV]},
+    ]
+
+    all_keys = list(tree.sources.keys())
+    log_suffix = "_log" if args.log_scale else ""
 
     # Plots everything separately
-    print("Plotting separate graphs. Saving to: '{}'".format(args.output_dir))
     if not args.show:
-        for key in tqdm(all_keys, leave=False):
+        for key in all_keys:
             dataset, mode, architecture, algo = key
-            try:
-                plot_with_std(tree,
-                              tag_sets=[key],
-                              y_axis=axis_labels[args.key],
-                              title="{}: {}".format(dataset, algo),
-                              err_style="unit_traces",
-                              )
-                path = os.path.join(args.output_dir, dataset, file_suffixes[args.key], algo)
-                if args.log_scale:
-                    plt.yscale("log")
-                    path += "_log"
-                save_plot(path, extension=args.extension)
-            except Exception as ex:
-                print("Failed for: {}".format(key))
-                print("Data shape: {}".format(tree.get(key).shape))
-                if args.verbose:
-                    print(" ============== EXCEPTION ============")
-                    print(ex)
-                    traceback.print_exc()
-                    print(" =====================================")
-                    print()
+            jobs.append({"kind": "curves",
+                         "path": os.path.join(args.output_dir, dataset, file_suffixes[args.key], algo) + log_suffix,
+                         "title": "{}: {}".format(dataset, algo),
+                         "tag_sets": [key],
+                         "kwargs": {"err_style": "unit_traces"}})
 
     # Plot version 1
-    print("Plotting joined graphs.")
     joined_keys = {}
     for d, m, a, algo in all_keys:
         if not (d, m, a) in joined_keys:
             joined_keys[(d, m, a)] = []
         joined_keys[(d, m, a)].append([d, m, a, algo])
 
-    best_runs = {
-        "mnist":
-            {"adagrad_l0.1",
-             "adam_l0.0001",
-             "nag_l1.0",
-             "sgd_dsqrt_l1.0"},
-        "UCI_Covertype":
-            {"adagrad_l0.01",
-             "adam_l0.0001",
-             "nag_l1.0",
-             "sgd_dsqrt_l1e-05"},
-        "UCI_Census":
-            {"adagrad_l0.01",
-             "adam_l0.0001",
-             "nag_l0.01",
-             "sgd_dsqrt_l1e-05"},
-
-        "UCI_Madelon":
-            {"adagrad_l0.0001",
-             "adam_l0.0001",
-             "nag_l0.1",
-             "sgd_dsqrt_l1e-05"},
-
-        "UCI_Bank":
-            {"adagrad_l0.01",
-             "adam_l0.0001",
-             "nag_l1.0",
-             "sgd_dsqrt_l1e-05"},
-        "Penn_shuttle":
-            {"adagrad_l0.01",
-             "adam_l0.0001",
-             "nag_l0.1",
-             "sgd_dsqrt_l0.0001"}
-    }
-    for best_set in best_runs.values():
-        best_set.add("scinol")
-        best_set.add("scinol2")
-        best_set.add("cocob")
-        best_set.add("prescinol_edt")
+    # Only figures whose runs or parameters changed since the last invocation are rendered
+    cache = BuildCache(os.path.join(args.output_dir, BUILD_CACHE_FILE))
+    if args.best_runs is not None:
+        best_runs = best_runs_sets(load_best_configs(args.best_runs))
+    else:
+        best_runs = best_runs_sets(cached_best_configs(args.log_dir, tree.sources, cache, filters, excludes))
 
-    for [d, m, a], tag_set in tqdm(joined_keys.items(), leave=False):
+    joined_jobs = []
+    for [d, m, a], tag_set in joined_keys.items():
         new_tag_set = []
         for tags in tag_set:
-            if tags[-1] in best_runs[d]:
+            if tags[-1] in best_runs.get((d, a), ()):
                 new_tag_set.append(tags)
+        if len(new_tag_set) == 0:
+            continue
         tag_set = sorted(new_tag_set, key=lambda x: x[3])
-        plot_with_std(tree,
-                      tag_sets=tag_set,
-                      y_axis=axis_labels[args.key],
-                      title=titles_dict[d],
-                      line=None
-                      )
-        path = os.path.join(args.output_dir, file_suffixes[args.key], d)
-        if args.log_scale:
-            plt.yscale("log")
-            path += "_log"
-
-        if args.show:
-            plt.show()
-        else:
-            save_plot(path, extension=args.extension)
-
-            # # Plot version 2
-            # for [d, m, a], tag_set in tqdm(joined_keys.items(), leave=False):
-            #     tag_set = sorted(tag_set, key=lambda x: x[3])
-            #     plot_with_std_v2(tree,
-            #                      tag_sets=tag_set,
-            #                      y_axis="cross entropy",
-            #                      title=titles_dict[d])
-            #     save_plot(os.path.join(args.output_dir, "all_v2", d) + "_v2",
-            #               extension=args.extension)
+        joined_jobs.append({"kind": "curves",
+                            "path": os.path.join(args.output_dir, file_suffixes[args.key], d) + log_suffix,
+                            "title": titles_dict[d],
+                            "tag_sets": tag_set,
+                            "kwargs": {"line": None}})
+
+    params = {name: getattr(args, name) for name in ("key", "extension", "log_scale", "streaming",
+                                                     "max_points", "downsample")}
+    if not args.show:
+        jobs += joined_jobs
+        joined_jobs = []
+    total_jobs = len(jobs)
+    jobs = stale_jobs(jobs, tree, cache, params, force=args.force)
+    tree.load(args.log_dir, filters, excludes, keys=job_keys(jobs + joined_jobs))
+    runs, t = load_artificial()
+
+    shared = {"args": args, "tree": tree, "runs": runs, "t": t}
+    print("Plotting {} graphs ({} up to date). Saving to: '{}'".format(len(jobs),
+                                                                      total_jobs - len(jobs),
+                                                                      args.output_dir))
+    rendered = render_jobs(render_figure, jobs, shared, processes=args.jobs)
+    for job, success in zip(jobs, rendered):
+        if success:
+            cache.update(job["output"], job["signature"])
+    cache.save()
+
+    for job in joined_jobs:
+        draw_figure(job, shared, plt.figure().gca())
+        plt.show()
+
+    # # Plot version 2
+    # for [d, m, a], tag_set in tqdm(joined_keys.items(), leave=False):
+    #     tag_set = sorted(tag_set, key=lambda x: x[3])
+    #     plot_with_std_v2(tree,
+    #                      tag_sets=tag_set,
+    #                      y_axis="cross entropy",
+    #                      title=titles_dict[d])
+    #     save_plot(os.path.join(args.output_dir, "all_v2", d) + "_v2",
+    #               extension=args.extension)
@@ -17,24 +17,33 @@ import json
 import six
 import numpy as np
 import h5py
-import codecs
+
+
+# characters left out of the encoded text, they still get an index
+BLACKLIST = ('\ufeff',)
+# elements written to the HDF5 file at a time, the whole array is never copied
+H5_WRITE_CHUNK = 1 << 20
+
+
+def _read_text(input_txt, encoding):
+    # same characters as codecs.open, which does not translate newlines unless the encoding is None
+    if encoding is None:
+        with open(input_txt, 'r') as f:
+            return f.read()
+    with open(input_txt, 'rb') as f:
+        return f.read().decode(encoding)
 
 
 def load_text(input_txt,
               encoding="utf-8",
               test_frac=0.1,
               verbose=False):
-    # First go the file once to see how big it is and to build the vocab
-    total_size = 0
-    chars = set()
-    blacklist = set(['\ufeff'])
-    with codecs.open(input_txt, 'r', encoding) as f:
-        for line in f:
-            total_size += len(line)
-            chars.update(line)
-    # for token in blacklist:
-    #     chars.remove(token)
-    token_to_idx = {k: idx for idx, k in enumerate(sorted(chars))}
+    text = _read_text(input_txt, encoding)
+    # code points of the characters, the vocab is sorted by them like sorted(chars)
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    total_size = len(codes)
+    chars = np.flatnonzero(np.bincount(codes)) if total_size > 0 else np.zeros(0, dtype=np.int64)
+    token_to_idx = {chr(code): idx for idx, code in enumerate(chars)}
     # Now we can figure out the split sizes
     test_size = int(test_frac * total_size)
     train_size = total_size - test_size
@@ -46,28 +55,27 @@ def load_text(input_txt,
         print('  Test size: %d' % test_size)
 
     # Choose the datatype based on the vocabulary size
-    dtype = np.uint32
-
-    # Just load data into memory ... we'll have to do something more clever
-    # for huge datasets but this should be fine for now
-    train = np.zeros(train_size, dtype=dtype)
-    test = np.zeros(test_size, dtype=dtype)
-    splits = [train, test]
-
-    # Go through the file again and write data to numpy arrays
-    split_idx, cur_idx = 0, 0
-    with codecs.open(input_txt, 'r', encoding) as f:
-        for line in f:
-            for char in line:
-                if char not in blacklist:
-                    splits[split_idx][cur_idx] = token_to_idx[char]
-                    cur_idx += 1
-                    if cur_idx == splits[split_idx].size:
-                        split_idx += 1
-                        cur_idx = 0
+    dtype = np.uint8 if len(chars) <= 1 << 8 else np.uint16 if len(chars) <= 1 << 16 else np.uint32
+
+    lookup = np.zeros(chars[-1] + 1 if len(chars) > 0 else 0, dtype=dtype)
+    lookup[chars] = np.arange(len(chars))
+    for token in BLACKLIST:
+        codes = codes[codes != ord(token)]
+    # blacklisted characters are counted in the split sizes, the end of test is padded with zeros instead
+    data = np.zeros(total_size, dtype=dtype)
+    data[:len(codes)] = lookup[codes]
+    train = data[:train_size]
+    test = data[train_size:]
     return train, test, token_to_idx
 
 
+def _write_h5(f, name, data):
+    # contiguous, so that datasets.py can memory map it
+    dataset = f.create_dataset(name, shape=data.shape, dtype=data.dtype)
+    for start in range(0, len(data), H5_WRITE_CHUNK):
+        dataset[start:start + H5_WRITE_CHUNK] = data[start:start + H5_WRITE_CHUNK]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(dest='input_txt')
@@ -95,8 +103,8 @@ if __name__ == '__main__':
         output_json = args.output + ".json"
 
         with h5py.File(output_h5, 'w') as f:
-            f.create_dataset('train', data=train)
-            f.create_dataset('test', data=test)
+            _write_h5(f, 'train', train)
+            _write_h5(f, 'test', test)
 
         # For 'bytes' encoding, replace non-ascii characters so the json dump
         # doesn't crash
@@ -0,0 +1,65 @@
+import glob
+import hashlib
+import json
+import os
+
+CACHE_DIR = ".cache"
+# everything that can change the results of a run
+CODE_FILES = ("test.py", "models.py", "datasets.py", "preprocess.py", "distributions.py", "short_names.py",
+              "checkpoints.py", "scinol/*.py", "cocob/*.py")
+# config keys that do not change the results of a single run
+IGNORED_CONFIG_KEYS = ("optimizers", "models", "datasets", "dataset", "times", "tblogdir", "no_tqdm", "verbose",
+                       "resume", "checkpoint_every_steps", "checkpoint_every_secs", "halving_eta",
+                       "halving_min_epochs", "intra_op_threads", "inter_op_threads", "cpu_affinity")
+
+_code_version = None
+
+
+def code_version():
+    global _code_version
+    if _code_version is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+        sha = hashlib.sha1()
+        for pattern in CODE_FILES:
+            for filename in sorted(glob.glob(os.path.join(root, pattern))):
+                sha.update(os.path.relpath(filename, root).encode())
+                with open(filename, "rb") as file:
+                    sha.update(file.read())
+        _code_version = sha.hexdigest()
+    return _code_version
+
+
+def job_key(dataset_name, preprocessing_version, model, model_args, optimizer_class, optimizer_args, config,
+            repeat):
+    job = {"dataset": dataset_name,
+           "preprocessing": preprocessing_version,
+           "model": model,
+           "model_args": model_args,
+           "optimizer": optimizer_class,
+           "optimizer_args": optimizer_args,
+           # unset keys read from the defaultdict config are None, the same as missing ones
+           "config": {k: v for k, v in config.items() if k not in IGNORED_CONFIG_KEYS and v is not None},
+           "repeat": repeat,
+           "code": code_version()}
+    return hashlib.sha1(json.dumps(job, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _path(tblogdir, key):
+    return os.path.join(tblogdir, CACHE_DIR, key + ".json")
+
+
+def load_result(tblogdir, key):
+    """Result of a finished run with the given key, None if it was not run yet."""
+    try:
+        with open(_path(tblogdir, key)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def store_result(tblogdir, key, result):
+    path = _path(tblogdir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as file:
+        json.dump(result, file)
+    os.replace(path + ".tmp", path)
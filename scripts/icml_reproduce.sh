@@ -3,13 +3,9 @@
 ACTUAL_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"/..
 cd ${ACTUAL_DIR}
 
-for i in `seq 1 10`; do
-    ./test.py -c configs/icml_paper/bank.yml
-    ./test.py -c configs/icml_paper/census.yml
-    ./test.py -c configs/icml_paper/covtype.yml
-    ./test.py -c configs/icml_paper/madelon.yml
-    ./test.py -c configs/icml_paper/mnist.yml
-    ./test.py -c configs/icml_paper/shuttle.yml
+# 10 repeats of every run, runs finished by a previous (interrupted) invocation are skipped
+for config in bank census covtype madelon mnist shuttle; do
+    ./test.py -c configs/icml_paper/${config}.yml --times 10 --cache
 done
 
 ./plot_linear.py --key cross_entropy
@@ -1,31 +1,45 @@
-from scinol import *
-import tensorflow as tf
-
-from cocob import COCOBOptimizer, COCOBOptimizer0
-
-sfmd = SFMDOptimizer
-nag = NAGOptimizer
-scinol = ScinolOptimizer
-scinol2 = Scinol2Optimizer
-scinola = ScinolAOptimizer
-scinol2a = Scinol2AOptimizer
-scinolb = ScinolBOptimizer
-scinol2b = Scinol2BOptimizer
-prescinol = PreScinolOptimizer
-prescinol2 = PreScinol2Optimizer
-prescinoldl = PreScinolDLOptimizer
-prescinol2dl = PreScinol2DLOptimizer
-scinol2dl = Scinol2DLOptimizer
-cocob = COCOBOptimizer
-cocob0 = COCOBOptimizer0
-
-rmsprop = tf.train.RMSPropOptimizer
-adagrad = tf.train.AdagradOptimizer
-adam = tf.train.AdamOptimizer
-adadelta = tf.train.AdadeltaOptimizer
+import importlib
+
+# short name -> "module:attribute", the module is imported only when the optimizer is used
+OPTIMIZERS = {
+    "sfmd": "scinol:SFMDOptimizer",
+    "nag": "scinol:NAGOptimizer",
+    "scinol": "scinol:ScinolOptimizer",
+    "scinol2": "scinol:Scinol2Optimizer",
+    "scinola": "scinol:ScinolAOptimizer",
+    "scinol2a": "scinol:Scinol2AOptimizer",
+    "scinolb": "scinol:ScinolBOptimizer",
+    "scinol2b": "scinol:Scinol2BOptimizer",
+    "prescinol": "scinol:PreScinolOptimizer",
+    "prescinol2": "scinol:PreScinol2Optimizer",
+    "prescinoldl": "scinol:PreScinolDLOptimizer",
+    "prescinol2dl": "scinol:PreScinol2DLOptimizer",
+    "scinol2dl": "scinol:Scinol2DLOptimizer",
+    "cocob": "cocob:COCOBOptimizer",
+    "cocob0": "cocob:COCOBOptimizer0",
+
+    "rmsprop": "tensorflow:train.RMSPropOptimizer",
+    "adagrad": "tensorflow:train.AdagradOptimizer",
+    "adam": "tensorflow:train.AdamOptimizer",
+    "adadelta": "tensorflow:train.AdadeltaOptimizer",
+    "sgd": "short_names:sgd",
+}
+
+
+def get_optimizer(name):
+    """Optimizer class (or factory) of a short name used in configs."""
+    if name not in OPTIMIZERS:
+        raise ValueError("Unknown optimizer: '{}', should be one of: {}".format(name, ", ".join(sorted(OPTIMIZERS))))
+    module, attribute = OPTIMIZERS[name].split(":")
+    optimizer = importlib.import_module(module)
+    for part in attribute.split("."):
+        optimizer = getattr(optimizer, part)
+    return optimizer
 
 
 def sgd(learning_rate, use_locking=False, name="SGD", decay="sqrt",*args,**kwargs):
+    import tensorflow as tf
+
     if decay is not None:
         t = tf.train.get_or_create_global_step()
         t = tf.assign_add(t, 1)
@@ -1,15 +1,53 @@
 #!/usr/bin/env python3
 
 import traceback
+import importlib
+import math
+import os
+import sys
+import queue
+import threading
+import json
 import argparse
 import ruamel.yaml as yaml
-from time import strftime
+import itertools as it
+from time import perf_counter, sleep, strftime
 from collections import defaultdict
-from models import *
-from datasets import *
-from short_names import *
+import numpy as np
+from short_names import get_optimizer
+from checkpoints import (AsyncCheckpoint, claim_unfinished, create_run_dir, find_finished, lock_run, mark_finished,
+                         mark_resumed, restore)
+from result_cache import job_key, load_result, store_result
+from job_queue import DEFAULT_STALE_SECS, JobQueue, RUNNING, worker_name
+from dataset_info import describe, estimate_costs, record_dataset, record_runtime
+from types import SimpleNamespace
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+
+class _LazyModule(object):
+    """Module imported on first use, tensorflow and the datasets (sklearn, h5py) take seconds to import and many
+    commands (--help, --show-datasets, --enqueue, --plan of cached datasets) never need them."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+tf = _LazyModule("tensorflow")
+_models = _LazyModule("models")
+_datasets = _LazyModule("datasets")
+
+
+def _load_dataset(name, config):
+    return getattr(_datasets, name)(**config)
+
+
 DEFAULT_TIMES = 1
 DEFAULT_TB_LOGDIR = "tb_logs"
 DEFAULT_LOGDIR = None
@@ -18,6 +56,49 @@ TESTBATCH_SIZE = 100000
 DEFAULT_EPOCHS = 30
 REGRESSION_LOSSES = ("abs", "squared")
 CLASSIFICATION_LOSSES = ("cross_entropy",)
+DIVERGED_FILE = "DIVERGED"
+DEFAULT_HALVING_ETA = 3
+DEFAULT_HALVING_MIN_EPOCHS = 1
+HALVING_LOG = "promotions.jsonl"
+DEFAULT_QUEUE_DIR = "job_queue"
+QUEUE_POLL_SECS = 10
+# config keys describing the sweep, not a single run
+SWEEP_CONFIG_KEYS = ("optimizers", "models", "datasets", "dataset")
+SWEEP_KEYS = ("values", "logrange", "linrange")
+# rough sizes for --plan
+EVENT_BYTES = 100
+TF_BASE_BYTES = 300 * 2 ** 20
+PLAN_BENCHMARK_STEPS = 50
+PLAN_BENCHMARK_TEST_ROWS = 10000
+MAX_RUNS_PER_GRAPH = 20
+
+
+def _sweep_values(value):
+    """Values of a single argument: {values: [...]}, {logrange: [start, stop, num]} or {linrange: [...]}
+    are expanded, anything else is a single value."""
+    if not isinstance(value, dict) or len(value) != 1 or next(iter(value)) not in SWEEP_KEYS:
+        return [value]
+    kind, spec = next(iter(value.items()))
+    if kind == "values":
+        return list(spec)
+    start, stop, num = spec
+    if num == 1:
+        return [start]
+    if kind == "logrange":
+        log_start, log_stop = math.log10(start), math.log10(stop)
+        values = [10 ** (log_start + i * (log_stop - log_start) / (num - 1)) for i in range(num)]
+    else:
+        values = [start + i * (stop - start) / (num - 1) for i in range(num)]
+    if isinstance(start, int) and isinstance(stop, int) and all(v == round(v) for v in values):
+        return [int(round(v)) for v in values]
+    # without float noise, the values end up in run names
+    return [float("{:.12g}".format(v)) for v in values]
+
+
+def _expand_args(args):
+    """Cartesian product of the swept values of all arguments."""
+    names = list(args)
+    return [dict(zip(names, values)) for values in it.product(*(_sweep_values(args[name]) for name in names))]
 
 
 # TODO parsing a list is not needed anymore . .. i think
@@ -36,13 +117,17 @@ def _parse_list_dict(list_or_dict):
     elif isinstance(list_or_dict, dict):
         return_list = []
         for key_class, instances in list_or_dict.items():
+            if isinstance(instances, dict):
+                instances = [instances]
             if not isinstance(instances, list):
-                return_list.append((key_class, {}))
-            else:
-                for args in instances:
-                    if args is None:
-                        args = {}
-                    return_list.append((key_class, args))
+                instances = [{}]
+            for args in instances:
+                if args is None:
+                    args = {}
+                for expanded_args in _expand_args(args):
+                    # overlapping sweeps
+                    if (key_class, expanded_args) not in return_list:
+                        return_list.append((key_class, expanded_args))
         return return_list
     else:
         raise ValueError("no list/dict")
@@ -56,36 +141,14 @@ def _parse_name(name, args):
     return s
 
 
-def test(
-        dataset,
-        model,
-        model_args,
-        optimizer_class,
-        optimizer_args,
-        tblogdir=DEFAULT_TB_LOGDIR,
-        logdir=DEFAULT_LOGDIR,
-        epochs=DEFAULT_EPOCHS,
-        train_histograms=False,
-        test_histograms=False,
-        tag=None,
-        train_logs=True,
-        no_tqdm=False,
-        embedding_size=None,
-        loss=None,
-        test_every=None,
-        verbose=False,
-        *args,
-        **kwargs):
-    # TODO add tag support
-    if tag is not None:
-        raise NotImplementedError()
-    if logdir is not None:
-        raise NotImplementedError()
+def _mark_diverged(prefix, step, loss, initial_loss):
+    tf.gfile.MakeDirs(prefix)
+    with open(os.path.join(prefix, DIVERGED_FILE), "w") as file:
+        json.dump({"step": int(step), "loss": float(loss), "initial_loss": float(initial_loss)}, file)
 
-    if test_every is None:
-        test_every = np.ceil(len(dataset.train[0])/dataset.train_batchsize)
-    tf.gfile.MakeDirs(tblogdir)
-    tf.reset_default_graph()
+
+def _build_model(dataset, model, model_args, embedding_size=None, loss=None):
+    """Placeholders, model and loss of a dataset in the default graph."""
     dropout_switch = tf.placeholder_with_default(1.0,
                                                  None,
                                                  name='dropout_switch')
@@ -95,14 +158,19 @@ def test(
         embeddings = tf.get_variable("embedding", [dataset.tokens_num, embedding_size],
                                      initializer=tf.random_normal_initializer, trainable=True)
         model_input = tf.nn.embedding_lookup(embeddings, x)
+    elif getattr(dataset, "input_scale", None) is not None:
+        # uint8 inputs are fed as they are stored, a quarter of the bytes of floats
+        x = tf.placeholder(tf.uint8, [None] + dataset.input_shape, name='x-input')
+        model_input = tf.cast(x, tf.float32) * dataset.input_scale
     else:
         x = tf.placeholder(tf.float32, [None] + dataset.input_shape, name='x-input')
         model_input = x
 
-    model = eval(model)(**model_args)
+    model = getattr(_models, model)(**model_args)
     model_output = model(model_input, dataset.outputs_num, dropout_switch=dropout_switch)
 
-    if dataset.task == CLASSIFICATION:
+    accuracy = None
+    if dataset.task == _datasets.CLASSIFICATION:
         if loss is None:
             loss = "cross_entropy"
         if loss == "cross_entropy":
@@ -121,6 +189,10 @@ def test(
                     flat_y = tf.reshape(model_output, [-1])
                     cross_entropy = tf.nn.sigmoid_cross_entropy_with_logits(labels=target, logits=flat_y)
                     correct_predictions = tf.equal(tf.cast(tf.greater(flat_y, 0), tf.float32), target)
+                elif getattr(dataset, "sparse_labels", False):
+                    target = tf.placeholder(tf.int32, [None], name='y-input')
+                    cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target, logits=model_output)
+                    correct_predictions = tf.equal(tf.argmax(model_output, 1, output_type=tf.int32), target)
                 else:
                     target = tf.placeholder(tf.float32, [None, dataset.outputs_num], name='y-input')
                     cross_entropy = tf.nn.softmax_cross_entropy_with_logits_v2(labels=target, logits=model_output)
@@ -150,101 +222,644 @@ def test(
             else:
                 raise NotImplementedError()
 
-    optimizer = eval(optimizer_class)(**optimizer_args)
-    preapply_ops = getattr(optimizer, "preapply_ops", None)
-    grads_and_vars = optimizer.compute_gradients(loss_op)
-
-    train_step = optimizer.apply_gradients(grads_and_vars)
-
-    # Summaries
-    summaries_prefix = dataset.get_name()
-    grad_hist_summaries = []
-    var_hist_summaries = []
-    for grad, var in grads_and_vars:
-        g_summary = tf.summary.histogram('{}/{}/gradients/{}'.format(summaries_prefix, model.name, var.name),
-                                         grad)
-        v_summary = tf.summary.histogram('{}/{}/{}'.format(summaries_prefix, model.name, var.name), var)
-        grad_hist_summaries.append(g_summary)
-        var_hist_summaries.append(v_summary)
-
-    loss_summary = tf.summary.scalar('{}/{}'.format(summaries_prefix, loss), loss_op)
-    summaries = [loss_summary]
-    if dataset.task == CLASSIFICATION:
-        acc_summary = tf.summary.scalar('{}/accuracy'.format(summaries_prefix), accuracy)
-        summaries.append(acc_summary)
-
-    if train_histograms:
-        train_summaries = tf.summary.merge_all()
-    else:
-        train_summaries = tf.summary.merge(summaries)
-    if test_histograms:
-        test_summaries = tf.summary.merge(summaries + var_hist_summaries)
-    else:
-        test_summaries = tf.summary.merge(summaries)
-
-    time = strftime("%m.%d_%H-%M-%S")
-    optim_name = optimizer.get_name().lower()
-    oargs = "_".join(k[0] + str(v) for k, v in sorted(optimizer_args.items()))
-    prefix = "{}/{}/{}/{}/{}_{}".format(tblogdir, dataset.get_name(), model.name, time, optim_name, oargs)
-    prefix = prefix.strip("_")
-    if train_logs:
-        train_writer = tf.summary.FileWriter(prefix + '/train',
-                                             graph=tf.get_default_graph(),
-                                             flush_secs=FLUSH_SECS)
-    else:
-        train_writer = None
-    test_writer = tf.summary.FileWriter(prefix + '/test',
-                                        graph=tf.get_default_graph(),
-                                        flush_secs=FLUSH_SECS)
-
-    sess = tf.Session()
-    sess.run(tf.global_variables_initializer())
-    batches_processed = 0
-    test_x, test_y = dataset.get_test_data()
-    pre_run_test_summary = sess.run(test_summaries,
-                                    feed_dict={x: test_x,
-                                               target: test_y,
-                                               dropout_switch: 0})
-    test_writer.add_summary(pre_run_test_summary, batches_processed)
-    if no_tqdm:
-        def trange(n, *_, **__):
-            for epoch in range(n):
-                print("Epoch {}/{}".format(epoch + 1, n))
-                yield epoch
+    return x, target, dropout_switch, model, loss, loss_op, accuracy
+
+
+def _session_config(intra_op_threads=None, inter_op_threads=None):
+    """Session with thread pools of its own of the given sizes, None for the tensorflow defaults."""
+    if intra_op_threads is None and inter_op_threads is None:
+        return None
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads or 0,
+                          inter_op_parallelism_threads=inter_op_threads or 0,
+                          use_per_session_threads=True)
+
+
+def _cpu_groups(cpu_affinity, workers):
+    """Disjoint groups of cpus (the listed ones or all available) for the workers, at most one group per cpu."""
+    cpus = list(cpu_affinity) if isinstance(cpu_affinity, list) else sorted(os.sched_getaffinity(0))
+    return [[int(cpu) for cpu in group] for group in np.array_split(cpus, min(workers, len(cpus)))]
+
+
+def _unscoped_name(name, scope):
+    return name[len(scope) + 1:] if name.startswith(scope + "/") else name
+
+
+class _ModelGraph(object):
+    """Placeholders, model, loss and summaries of a (dataset, model), built once and shared by the runs of all
+    optimizers. A run adds only its optimizer to the graph, in a variable scope of its own, and initializes only
+    the model variables and its own ones. The graph is rebuilt every MAX_RUNS_PER_GRAPH runs so that it does not
+    keep growing."""
 
+    def __init__(self, dataset, model, model_args, embedding_size=None, loss=None, session_config=None):
+        self._args = dataset, model, model_args, embedding_size, loss
+        self.session_config = session_config
+        self.sess = None
+        self._build()
+
+    def _build(self):
+        self.close()
+        dataset, model, model_args, embedding_size, loss = self._args
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            (self.x, self.target, self.dropout_switch, self.model, self.loss, self.loss_op,
+             self.accuracy) = _build_model(dataset, model, model_args, embedding_size, loss)
+            # outside of the run scopes, so that its name does not depend on the run, optimizers of all runs use it
+            tf.train.get_or_create_global_step()
+            self.variables = tf.global_variables()
+
+            summaries_prefix = dataset.get_name()
+            self.summaries = [tf.summary.scalar('{}/{}'.format(summaries_prefix, self.loss), self.loss_op)]
+            if dataset.task == _datasets.CLASSIFICATION:
+                self.summaries.append(tf.summary.scalar('{}/accuracy'.format(summaries_prefix), self.accuracy))
+            self.var_hist_summaries = [
+                tf.summary.histogram('{}/{}/{}'.format(summaries_prefix, self.model.name, var.name), var)
+                for var in tf.trainable_variables()]
+        self.sess = tf.Session(graph=self.graph, config=self.session_config)
+        self.runs = 0
+
+    def begin_run(self):
+        """Variable scope of the next run."""
+        if self.runs >= MAX_RUNS_PER_GRAPH:
+            self._build()
+        self.runs += 1
+        return "run_{}".format(self.runs - 1)
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+
+
+def test(
+        dataset,
+        model,
+        model_args,
+        optimizer_class,
+        optimizer_args,
+        tblogdir=DEFAULT_TB_LOGDIR,
+        logdir=DEFAULT_LOGDIR,
+        epochs=DEFAULT_EPOCHS,
+        train_histograms=False,
+        test_histograms=False,
+        tag=None,
+        train_logs=True,
+        no_tqdm=False,
+        embedding_size=None,
+        loss=None,
+        test_every=None,
+        divergence_ratio=None,
+        checkpoint_every_steps=None,
+        checkpoint_every_secs=None,
+        resume=False,
+        repeat=0,
+        model_graph=None,
+        worker=None,
+        intra_op_threads=None,
+        inter_op_threads=None,
+        verbose=False,
+        *args,
+        **kwargs):
+    # TODO add tag support
+    if tag is not None:
+        raise NotImplementedError()
+    if logdir is not None:
+        raise NotImplementedError()
+
+    if test_every is None:
+        test_every = np.ceil(len(dataset.train[0])/dataset.train_batchsize)
+    tf.gfile.MakeDirs(tblogdir)
+    own_graph = model_graph is None
+    if own_graph:
+        model_graph = _ModelGraph(dataset, model, model_args, embedding_size, loss,
+                                  _session_config(intra_op_threads, inter_op_threads))
+    scope = model_graph.begin_run()
+    x, target, dropout_switch = model_graph.x, model_graph.target, model_graph.dropout_switch
+    model, loss, loss_op, accuracy = model_graph.model, model_graph.loss, model_graph.loss_op, model_graph.accuracy
+    sess = model_graph.sess
+
+    with model_graph.graph.as_default(), tf.variable_scope(scope):
+        known_variables = set(tf.global_variables())
+        optimizer = get_optimizer(optimizer_class)(**optimizer_args)
+        preapply_ops = getattr(optimizer, "preapply_ops", None)
+        grads_and_vars = optimizer.compute_gradients(loss_op)
+
+        train_step = optimizer.apply_gradients(grads_and_vars)
+
+        # Divergence watchdog: non finite loss on any batch or test loss above divergence_ratio * initial test loss
+        watchdog = divergence_ratio is not None
+        initial_loss = tf.placeholder_with_default(np.float32(np.inf), [], name="initial_loss")
+        diverged_op = tf.logical_or(tf.logical_not(tf.is_finite(loss_op)),
+                                    loss_op > float(divergence_ratio or np.inf) * initial_loss)
+
+        # Summaries, the scalars and variable histograms are shared by all runs in the graph
+        summaries_prefix = dataset.get_name()
+        grad_hist_summaries = []
+        for grad, var in grads_and_vars:
+            g_summary = tf.summary.histogram('{}/{}/gradients/{}'.format(summaries_prefix, model.name, var.name),
+                                             grad)
+            grad_hist_summaries.append(g_summary)
+        summaries = model_graph.summaries
+        var_hist_summaries = model_graph.var_hist_summaries
+
+        if train_histograms:
+            train_summaries = tf.summary.merge(summaries + grad_hist_summaries + var_hist_summaries)
+        else:
+            train_summaries = tf.summary.merge(summaries)
+        if test_histograms:
+            test_summaries = tf.summary.merge(summaries + var_hist_summaries)
+        else:
+            test_summaries = tf.summary.merge(summaries)
+
+        time = strftime("%m.%d_%H-%M-%S")
+        optim_name = optimizer.get_name().lower()
+        oargs = "_".join(k[0] + str(v) for k, v in sorted(optimizer_args.items()))
+        run_name = "{}_{}".format(optim_name, oargs).strip("_")
+        prefix = None
+        checkpoint_values, checkpoint_meta = None, None
+        if resume:
+            run_pattern = "{}/{}/{}/*/{}".format(tblogdir, dataset.get_name(), model.name, run_name)
+            # repeats that already finished are skipped
+            finished = [meta for meta in find_finished(run_pattern)
+                        if meta["epochs"] == epochs and meta.get("repeat") == repeat]
+            if len(finished) > 0:
+                print("Skipping finished run: {} (repeat {})".format(run_name, repeat))
+                if own_graph:
+                    model_graph.close()
+                return float(finished[0]["final_loss"])
+            # continue the unfinished run of this repeat, unless another worker is running it; its logs are appended to
+            claimed = claim_unfinished(run_pattern, repeat=repeat, epochs=epochs)
+            if claimed is not None:
+                prefix, lock, checkpoint_values, checkpoint_meta = claimed
+        if prefix is None:
+            prefix = create_run_dir("{}/{}/{}".format(tblogdir, dataset.get_name(), model.name), time, run_name,
+                                    worker)
+            lock = lock_run(prefix)
+        if train_logs:
+            train_writer = tf.summary.FileWriter(prefix + '/train',
+                                                 flush_secs=FLUSH_SECS)
+        else:
+            train_writer = None
+        # the graph grows with every run on it, it is written only by the first one
+        test_writer = tf.summary.FileWriter(prefix + '/test',
+                                            graph=model_graph.graph if model_graph.runs == 1 else None,
+                                            flush_secs=FLUSH_SECS)
+
+        # fresh model variables and global step first, initial values of some slots are read from them
+        new_variables = [v for v in tf.global_variables() if v not in known_variables]
+        sess.run(tf.variables_initializer(model_graph.variables))
+        sess.run(tf.variables_initializer(new_variables))
+        # model variables, global step and optimizer slots, named the same whatever the run scope
+        variables = {_unscoped_name(v.name, scope): v for v in model_graph.variables + new_variables}
+        batches_processed = 0
+        start_epoch, start_batch, rng_state = 0, 0, None
+        if checkpoint_meta is None:
+            test_x, test_y = dataset.get_test_data()
+            pre_run_test_summary, start_loss = sess.run([test_summaries, loss_op],
+                                                        feed_dict={x: test_x,
+                                                                   target: test_y,
+                                                                   dropout_switch: 0})
+            test_writer.add_summary(pre_run_test_summary, batches_processed)
+            final_loss = start_loss
+        else:
+            restore(sess, variables, checkpoint_values)
+            batches_processed = checkpoint_meta["step"]
+            start_epoch = checkpoint_meta["epoch"]
+            start_batch = checkpoint_meta["batch"]
+            rng_state = checkpoint_meta["rng_state"]
+            start_loss = checkpoint_meta["start_loss"]
+            final_loss = checkpoint_meta["final_loss"]
+            mark_resumed(prefix)
+            print("Resuming '{}' from step {}".format(prefix, batches_processed))
+        checkpoint = AsyncCheckpoint(prefix, checkpoint_every_steps, checkpoint_every_secs)
+        train_fetches = [train_step]
+        if watchdog:
+            train_fetches.append(diverged_op)
+        diverged = None
+        if no_tqdm:
+            def trange(n, *_, **__):
+                for epoch in range(n):
+                    print("Epoch {}/{}".format(epoch + 1, n))
+                    yield epoch
+
+        else:
+            from tqdm import trange
+
+        for epoch in trange(epochs, desc=run_name):
+            if epoch < start_epoch:
+                continue
+            if epoch == start_epoch and rng_state is not None:
+                # the same shuffling of the interrupted epoch
+                np.random.set_state(rng_state)
+            epoch_rng_state = np.random.get_state()
+            for batch, (bx, by) in enumerate(dataset.train_batches()):
+                if epoch == start_epoch and batch < start_batch:
+                    continue
+                batches_processed += 1
+                if preapply_ops is not None:
+                    sess.run(preapply_ops, feed_dict={x: bx, dropout_switch: 1})
+                if train_logs:
+                    train_summary, *results = sess.run([train_summaries] + train_fetches,
+                                                       feed_dict={x: bx,
+                                                                  target: by,
+                                                                  dropout_switch: 1})
+                    train_writer.add_summary(train_summary, batches_processed)
+                else:
+                    results = sess.run(train_fetches,
+                                       feed_dict={x: bx,
+                                                  target: by,
+                                                  dropout_switch: 1})
+                if watchdog and results[1]:
+                    diverged = batches_processed, np.nan
+                    break
+                if batches_processed % test_every == 0:
+                    test_x, test_y = dataset.get_test_data()
+                    test_summary, test_loss, test_diverged = sess.run([test_summaries, loss_op, diverged_op],
+                                                                      feed_dict={x: test_x,
+                                                                                 target: test_y,
+                                                                                 initial_loss: start_loss,
+                                                                                 dropout_switch: 0})
+                    test_writer.add_summary(test_summary, batches_processed)
+                    final_loss = test_loss
+                    if watchdog and test_diverged:
+                        diverged = batches_processed, test_loss
+                        break
+                if checkpoint.due(batches_processed):
+                    checkpoint.save(sess, variables, batches_processed, epoch_rng_state,
+                                    epoch=epoch,
+                                    batch=batch + 1,
+                                    epochs=epochs,
+                                    repeat=repeat,
+                                    start_loss=float(start_loss),
+                                    final_loss=float(final_loss))
+            if diverged is not None:
+                step, loss_value = diverged
+                _mark_diverged(prefix, step, loss_value, start_loss)
+                final_loss = np.inf
+                print("Run '{}' diverged at step {} (loss: {}, initial loss: {}), aborting it.".format(
+                    prefix, step, loss_value, start_loss))
+                break
+
+        # the run is complete, nothing to resume
+        checkpoint.remove()
+        mark_finished(prefix, epochs=epochs, repeat=repeat, final_loss=float(final_loss))
+        lock.close()
+        if train_writer is not None:
+            train_writer.flush()
+            train_writer.close()
+        test_writer.flush()
+        test_writer.close()
+        if own_graph:
+            model_graph.close()
+        return float(final_loss)
+
+
+def _run_test(dataset, model, model_args, optimizer_class, optimizer_args, config, repeat=0, use_cache=False,
+              reraise=False, **kwargs):
+    """Runs a single test, returns its final test loss (inf if it failed).
+    With use_cache a run that already finished with the same data, code, config and repeat index is skipped."""
+    tblogdir = config.get("tblogdir") or DEFAULT_TB_LOGDIR
+    if use_cache:
+        key = job_key(dataset.get_name(), _datasets.PREPROCESSING_VERSION, model, model_args, optimizer_class,
+                      optimizer_args, config, repeat)
+        result = load_result(tblogdir, key)
+        if result is not None:
+            print("Skipping finished run: {} {} (repeat {})".format(optimizer_class, optimizer_args, repeat))
+            return result["final_loss"]
+    start = perf_counter()
+    try:
+        loss = test(
+            dataset=dataset,
+            model=model,
+            model_args=model_args,
+            optimizer_class=optimizer_class,
+            optimizer_args=optimizer_args,
+            repeat=repeat,
+            **kwargs,
+            **config)
+    except Exception as ex:
+        print("======================= EXCEPTION ===================================")
+        print("========================== {} =======================================".format(
+            optimizer_class))
+        print(ex)
+        traceback.print_exc(file=sys.stdout)
+        print("==========================================")
+        if reraise:
+            raise
+        return np.inf
+    record_runtime(dataset, model, optimizer_class, config.get("epochs") or DEFAULT_EPOCHS, perf_counter() - start)
+    if use_cache:
+        store_result(tblogdir, key, {"dataset": dataset.get_name(),
+                                     "model": _parse_name(model, model_args),
+                                     "optimizer": optimizer_class,
+                                     "args": optimizer_args,
+                                     "repeat": repeat,
+                                     "final_loss": loss})
+    return loss
+
+
+def _halving_rungs(epochs, eta, min_epochs):
+    rungs = []
+    budget = min_epochs
+    while budget < epochs:
+        rungs.append(budget)
+        budget *= eta
+    return rungs
+
+
+def successive_halving(dataset, model, model_args, optimizers, config, **kwargs):
+    """Runs all configurations of every optimizer for a short budget and continues only the best 1/eta of them
+    for eta times longer, until one is left or the budget reaches the full number of epochs. Survivors are
+    trained from scratch for the full number of epochs and logged to tblogdir, the shorter runs go to
+    tblogdir + "_halving" along with a log of promotions."""
+    # .get, config is a defaultdict and missing keys would be passed to test() as None
+    eta = config.get("halving_eta") or DEFAULT_HALVING_ETA
+    epochs = config.get("epochs") or DEFAULT_EPOCHS
+    times = config.get("times") or DEFAULT_TIMES
+    tblogdir = config.get("tblogdir") or DEFAULT_TB_LOGDIR
+    halving_dir = tblogdir + "_halving"
+    rungs = _halving_rungs(epochs, eta, config.get("halving_min_epochs") or DEFAULT_HALVING_MIN_EPOCHS)
+
+    families = defaultdict(list)
+    for optimizer_class, optimizer_args in optimizers:
+        families[optimizer_class].append(optimizer_args)
+
+    for optimizer_class, candidates in sorted(families.items()):
+        for rung, rung_epochs in enumerate(rungs):
+            if len(candidates) == 1:
+                break
+            rung_config = dict(config, epochs=rung_epochs, tblogdir=halving_dir)
+            losses = [np.mean([_run_test(dataset, model, model_args, optimizer_class, optimizer_args, rung_config,
+                                         repeat=repeat, **kwargs)
+                               for repeat in range(times)])
+                      for optimizer_args in candidates]
+            keep = int(np.ceil(len(candidates) / eta))
+            # nan losses sort last
+            promoted = sorted(np.argsort(losses, kind="stable")[:keep])
+
+            tf.gfile.MakeDirs(halving_dir)
+            with open(os.path.join(halving_dir, HALVING_LOG), "a") as file:
+                for i, (optimizer_args, loss) in enumerate(zip(candidates, losses)):
+                    record = {"dataset": dataset.get_name(),
+                              "model": _parse_name(model, model_args),
+                              "optimizer": optimizer_class,
+                              "args": optimizer_args,
+                              "rung": rung,
+                              "epochs": rung_epochs,
+                              "loss": float(loss),
+                              "promoted": bool(i in promoted)}
+                    file.write(json.dumps(record) + "\n")
+            candidates = [candidates[i] for i in promoted]
+            print("Rung {} ({} epochs) of '{}': promoted {}".format(rung, rung_epochs, optimizer_class,
+                                                                    ", ".join(map(str, candidates))))
+
+        for optimizer_args in candidates:
+            for repeat in range(times):
+                _run_test(dataset, model, model_args, optimizer_class, optimizer_args, config, repeat=repeat,
+                          **kwargs)
+
+
+def _expand_jobs(datasets, models, optimizers, config):
+    """Every single run of a config as a json serializable job for the queue, the longest first so that the
+    workers finish at about the same time."""
+    job_config = {k: v for k, v in config.items() if k not in SWEEP_CONFIG_KEYS}
+    jobs = []
+    for dataset_name in datasets:
+        for model, model_args in models:
+            for optimizer_class, optimizer_args in sorted(optimizers, key=lambda x: x[0]):
+                for repeat in range(config["times"] or DEFAULT_TIMES):
+                    jobs.append({"dataset": dataset_name,
+                                 "model": model,
+                                 "model_args": model_args,
+                                 "optimizer_class": optimizer_class,
+                                 "optimizer_args": optimizer_args,
+                                 "repeat": repeat,
+                                 "config": job_config})
+    costs = estimate_costs(jobs, default_epochs=DEFAULT_EPOCHS)
+    order = sorted(range(len(jobs)), key=lambda i: -costs[i])
+    return [jobs[i] for i in order]
+
+
+def work(queue_dir, stale_secs=DEFAULT_STALE_SECS, use_cache=False, resume=False, verbose=False):
+    """Runs jobs from the queue until there are no pending or running ones left."""
+    queue = JobQueue(queue_dir)
+    dataset, dataset_key = None, None
+    model_graph, model_key = None, None
+    while True:
+        requeued = queue.requeue_stale(stale_secs)
+        if requeued > 0:
+            print("Requeued {} stale jobs".format(requeued))
+        claimed = queue.claim()
+        if claimed is None:
+            if queue.counts()[RUNNING] == 0:
+                break
+            # running jobs of other workers may still come back
+            sleep(QUEUE_POLL_SECS)
+            continue
+        name, job = claimed
+        stop_heartbeat = queue.heartbeat(name)
+        try:
+            config = defaultdict(lambda: None, job["config"])
+            if resume:
+                config["resume"] = True
+            # consecutive jobs usually share the dataset
+            key = job["dataset"], json.dumps(job["config"], sort_keys=True)
+            if key != dataset_key:
+                if model_graph is not None:
+                    model_graph.close()
+                dataset, dataset_key, model_graph, model_key = None, None, None, None
+                dataset = _load_dataset(job["dataset"], config)
+                dataset_key = key
+                record_dataset(job["dataset"], dataset, config)
+            if model_key != (job["model"], job["model_args"]):
+                if model_graph is not None:
+                    model_graph.close()
+                model_graph = _ModelGraph(dataset, job["model"], job["model_args"], config["embedding_size"],
+                                          config["loss"],
+                                          _session_config(config["intra_op_threads"], config["inter_op_threads"]))
+                model_key = job["model"], job["model_args"]
+            print("Job '{}': dataset: '{}', model: '{}', optimizer: {} {} (repeat {})".format(
+                name, job["dataset"], _parse_name(job["model"], job["model_args"]), job["optimizer_class"],
+                job["optimizer_args"], job["repeat"]))
+            loss = _run_test(dataset, job["model"], job["model_args"], job["optimizer_class"],
+                             job["optimizer_args"], config, repeat=job["repeat"], use_cache=use_cache, reraise=True,
+                             model_graph=model_graph, worker=worker_name(), verbose=verbose)
+            queue.finish(name, dict(job, final_loss=loss))
+        except Exception:
+            queue.finish(name, dict(job, error=traceback.format_exc()), failed=True)
+        finally:
+            stop_heartbeat.set()
+    print("No jobs left in '{}': {}".format(queue_dir, queue.counts()))
+
+
+def run_concurrent(jobs, workers, config, **kwargs):
+    """Runs jobs (from _expand_jobs) in threads of this process, each thread with its own graphs and sessions;
+    tensorflow releases the GIL while it runs ops. Every session gets thread pools of its own, by default with
+    the cpus split evenly among the workers; with cpu_affinity in the config every worker (and the tensorflow
+    threads it starts) is pinned to its own group of cpus."""
+    cpu_affinity = config.get("cpu_affinity")
+    groups = _cpu_groups(cpu_affinity, workers)
+    if len(groups) < workers:
+        print("Running {} workers instead of {}, one per cpu".format(len(groups), workers))
+        workers = len(groups)
+    pending = queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    datasets = {}
+    datasets_lock = threading.Lock()
+
+    def get_dataset(name):
+        with datasets_lock:
+            if name not in datasets:
+                datasets[name] = _load_dataset(name, config)
+                record_dataset(name, datasets[name], config)
+            return datasets[name]
+
+    def work(worker):
+        if cpu_affinity:
+            os.sched_setaffinity(0, groups[worker])
+        session_config = _session_config(config.get("intra_op_threads") or len(groups[worker]),
+                                         config.get("inter_op_threads") or 1)
+        model_graphs = {}
+        while True:
+            try:
+                job = pending.get_nowait()
+            except queue.Empty:
+                break
+            dataset = get_dataset(job["dataset"])
+            key = job["dataset"], job["model"], json.dumps(job["model_args"], sort_keys=True)
+            if key not in model_graphs:
+                # jobs are sorted by cost, graphs of other datasets are not needed anymore
+                for model_graph in model_graphs.values():
+                    model_graph.close()
+                model_graphs = {key: _ModelGraph(dataset, job["model"], job["model_args"], config.get("embedding_size"),
+                                                 config.get("loss"), session_config)}
+            _run_test(dataset, job["model"], job["model_args"], job["optimizer_class"], job["optimizer_args"],
+                      config, repeat=job["repeat"], model_graph=model_graphs[key], **kwargs)
+        for model_graph in model_graphs.values():
+            model_graph.close()
+
+    threads = [threading.Thread(target=work, args=(worker,), daemon=True) for worker in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _descriptor_dataset(descriptor):
+    # stands in for a loaded dataset when only the graph is needed
+    return SimpleNamespace(input_shape=descriptor["input_shape"],
+                           outputs_num=descriptor["outputs"],
+                           task=descriptor["task"],
+                           sequential=descriptor["sequential"],
+                           use_embeddings=descriptor["use_embeddings"],
+                           tokens_num=descriptor["tokens_num"],
+                           input_scale=descriptor.get("input_scale"),
+                           sparse_labels=descriptor.get("sparse_labels", False),
+                           get_name=lambda: descriptor["name"])
+
+
+def _data_bytes(descriptor):
+    """Bytes of the inputs and labels of a dataset, plus the copy of the test set fed to tf."""
+    rows = descriptor["train_size"] + descriptor["test_size"]
+    features = descriptor["features"]
+    if "input_itemsize" in descriptor:
+        input_bytes = descriptor["input_itemsize"]
+        label_bytes = descriptor["label_itemsize"] * descriptor["label_width"]
     else:
-        from tqdm import trange
+        # descriptors recorded before the dtypes were
+        input_bytes = 1 if descriptor.get("input_scale") is not None else 8
+        label_bytes = 4 if descriptor.get("sparse_labels") else 8 * max(descriptor["outputs"], 1)
+    fed_bytes = 1 if descriptor.get("input_scale") is not None else 4
+    return rows * (features * input_bytes + label_bytes) + descriptor["test_size"] * features * fed_bytes
+
+
+def _random_feed(placeholder, rows, high):
+    shape = [rows] + placeholder.shape.as_list()[1:]
+    if placeholder.dtype.is_integer:
+        return np.random.randint(0, max(high, 1), shape)
+    return np.random.rand(*shape).astype(np.float32)
 
-    for _ in trange(epochs, desc="{}_{}".format(optim_name, oargs).strip("_")):
-        for bx, by in dataset.train_batches():
-            batches_processed += 1
+
+def _profile(descriptor, model, model_args, optimizer_class, optimizer_args, config):
+    """Model parameters, optimizer variables, graph size and measured seconds of a train step and of a test
+    evaluation, with random data of the shape of the dataset."""
+    tf.reset_default_graph()
+    dataset = _descriptor_dataset(descriptor)
+    x, target, dropout_switch, _, _, loss_op, _ = _build_model(dataset, model, model_args,
+                                                               config.get("embedding_size"), config.get("loss"))
+    params = sum(int(np.prod(v.shape.as_list())) for v in tf.trainable_variables())
+    optimizer = get_optimizer(optimizer_class)(**optimizer_args)
+    preapply_ops = getattr(optimizer, "preapply_ops", None)
+    train_step = optimizer.apply_gradients(optimizer.compute_gradients(loss_op))
+    variables = sum(int(np.prod(v.shape.as_list())) for v in tf.global_variables())
+    graph_bytes = tf.get_default_graph().as_graph_def().ByteSize()
+
+    batchsize = config.get("train_batchsize") or 1
+    x_high = descriptor["tokens_num"] if descriptor["use_embeddings"] else 256
+    train_feed = {x: _random_feed(x, batchsize, x_high),
+                  target: _random_feed(target, batchsize, descriptor["outputs"]),
+                  dropout_switch: 1}
+    test_rows = min(descriptor["test_size"], PLAN_BENCHMARK_TEST_ROWS)
+    test_feed = {x: _random_feed(x, test_rows, x_high),
+                 target: _random_feed(target, test_rows, descriptor["outputs"]),
+                 dropout_switch: 0}
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for i in range(5 + PLAN_BENCHMARK_STEPS):
+            if i == 5:
+                start = perf_counter()
             if preapply_ops is not None:
-                sess.run(preapply_ops, feed_dict={x: bx, dropout_switch: 1})
-            if train_logs:
-                train_summary, _ = sess.run([train_summaries, train_step],
-                                            feed_dict={x: bx,
-                                                       target: by,
-                                                       dropout_switch: 1})
-                train_writer.add_summary(train_summary, batches_processed)
-            else:
-                sess.run(train_step,
-                         feed_dict={x: bx,
-                                    target: by,
-                                    dropout_switch: 1})
-            if batches_processed % test_every == 0:
-                test_x, test_y = dataset.get_test_data()
-                test_summary = sess.run(test_summaries,
-                                        feed_dict={x: test_x,
-                                                   target: test_y,
-                                                   dropout_switch: 0})
-                test_writer.add_summary(test_summary, batches_processed)
-
-    if train_writer is not None:
-        train_writer.flush()
-        train_writer.close()
-    test_writer.flush()
-    test_writer.close()
-    sess.close()
+                sess.run(preapply_ops, feed_dict={x: train_feed[x], dropout_switch: 1})
+            sess.run(train_step, feed_dict=train_feed)
+        step_seconds = (perf_counter() - start) / PLAN_BENCHMARK_STEPS
+        start = perf_counter()
+        sess.run(loss_op, feed_dict=test_feed)
+        test_seconds = (perf_counter() - start) * descriptor["test_size"] / max(test_rows, 1)
+    return params, variables - params, graph_bytes, step_seconds, test_seconds
+
+
+def plan(datasets, models, optimizers, config):
+    """Estimated steps, memory, log volume and cpu time of every run of a config, without loading any data
+    (except for datasets without a cached descriptor)."""
+    epochs = config.get("epochs") or DEFAULT_EPOCHS
+    times = config.get("times") or DEFAULT_TIMES
+    batchsize = config.get("train_batchsize") or 1
+    header = ["dataset", "model", "optimizer", "runs", "steps", "params", "opt. vars", "RAM MB", "logs MB", "hours"]
+    lines = []
+    total_seconds, total_log_bytes, peak_ram = 0, 0, 0
+    for dataset_name in datasets:
+        descriptor = describe(dataset_name, config)
+        if descriptor is None:
+            print("No cached descriptor of '{}', loading it once ...".format(dataset_name))
+            record_dataset(dataset_name, _load_dataset(dataset_name, config), config)
+            descriptor = describe(dataset_name, config)
+        train_size, test_size = descriptor["train_size"], descriptor["test_size"]
+        steps_per_epoch = int(np.ceil(train_size / batchsize))
+        steps = epochs * steps_per_epoch
+        test_every = config.get("test_every") or steps_per_epoch
+        evaluations = steps // test_every + 1
+        data_bytes = _data_bytes(descriptor)
+        for model, model_args in models:
+            for optimizer_class, optimizer_args in sorted(optimizers, key=lambda x: x[0]):
+                params, slots, graph_bytes, step_seconds, test_seconds = _profile(
+                    descriptor, model, model_args, optimizer_class, optimizer_args, config)
+                # variables, their gradients and temporaries of updates
+                ram = TF_BASE_BYTES + data_bytes + 3 * 4 * (params + slots)
+                writers = 2 if config.get("train_logs", True) else 1
+                events = evaluations + (steps if writers == 2 else 0)
+                log_bytes = events * EVENT_BYTES + writers * graph_bytes
+                seconds = steps * step_seconds + evaluations * test_seconds
+                lines.append([descriptor["name"], _parse_name(model, model_args),
+                              _parse_name(optimizer_class, optimizer_args), times, steps, params, slots,
+                              ram / 2 ** 20, log_bytes / 2 ** 20, seconds / 3600])
+                total_seconds += times * seconds
+                total_log_bytes += times * log_bytes
+                peak_ram = max(peak_ram, ram)
+    import tabulate
+
+    print(tabulate.tabulate(lines, header, floatfmt=".2f"))
+    print("Runs: {}, CPU hours: {:.1f}, logs: {:.2f} GB, peak RAM of a run: {:.0f} MB".format(
+        sum(line[3] for line in lines), total_seconds / 3600, total_log_bytes / 2 ** 30, peak_ram / 2 ** 20))
 
 
 if __name__ == '__main__':
@@ -278,14 +893,87 @@ if __name__ == '__main__':
             help="shows some descriptions of loaded datasets and exits",
             default=False,
         )
+        parser.add_argument(
+            "--plan",
+            action="store_true",
+            help="estimates steps, memory, log volume and cpu time of the runs of the config and exits",
+            default=False,
+        )
+        parser.add_argument(
+            "--concurrent",
+            metavar="N",
+            type=int,
+            help="runs N jobs at a time in threads of this process (see intra_op_threads, inter_op_threads and "
+                 "cpu_affinity in the config)",
+            default=None)
+        parser.add_argument(
+            "--halving",
+            action="store_true",
+            help="successive halving over the arguments of every optimizer instead of running the whole grid "
+                 "(see halving_eta and halving_min_epochs in the config)",
+            default=False,
+        )
+        parser.add_argument(
+            "--times",
+            type=int,
+            help="number of repeats of every run, overrides 'times' from the config",
+            default=None,
+        )
+        parser.add_argument(
+            "--cache",
+            action="store_true",
+            help="skip runs that already finished with the same data, code, config and repeat index "
+                 "(recorded in <tblogdir>/.cache)",
+            default=False,
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="continue unfinished runs from their checkpoints (see checkpoint_every_steps and "
+                 "checkpoint_every_secs in the config)",
+            default=False,
+        )
+        parser.add_argument(
+            "--enqueue",
+            metavar="YAML_FILE",
+            type=str,
+            help="puts every run of the config into the job queue (--queue-dir) instead of running them",
+            default=None)
+        parser.add_argument(
+            "--worker",
+            action="store_true",
+            help="runs jobs from the job queue (--queue-dir) until it is empty",
+            default=False,
+        )
+        parser.add_argument(
+            "--queue-dir",
+            metavar="DIR",
+            type=str,
+            help="job queue directory, shared by all the workers",
+            default=DEFAULT_QUEUE_DIR)
+        parser.add_argument(
+            "--stale-secs",
+            type=int,
+            help="jobs whose worker did not report for that long are put back to the queue",
+            default=DEFAULT_STALE_SECS)
 
         args = parser.parse_args()
 
+        if args.worker:
+            work(args.queue_dir, args.stale_secs, use_cache=args.cache, resume=args.resume, verbose=args.verbose)
+            exit(0)
+        if args.enqueue is not None:
+            args.config = args.enqueue
+
         if args.tag is not None:
             raise NotImplementedError("tag ...")
 
         try:
             config = defaultdict(lambda: None, yaml.safe_load(open(args.config)))
+            if args.resume:
+                config["resume"] = True
+            if args.times is not None:
+                config["times"] = args.times
         except:
             print("Failed to load config!")
             traceback.print_exc(file=sys.stdout)
@@ -330,47 +1018,61 @@ if __name__ == '__main__':
         else:
             datasets = config["datasets"]
 
+        if args.plan:
+            plan(datasets, models, optimizers, config)
+            exit(0)
         if args.show_datasets:
-            header = "Name", "size", "features", "classes", "scale ", "spread"
+            header = "Name", "size", "features", "classes", "scale ", "spread", "sparsity"
             lines = []
             for dataset_name in datasets:
-                dataset = eval(dataset_name)(**config)
+                descriptor = describe(dataset_name, config)
+                if descriptor is None or "sparsity" not in descriptor:
+                    record_dataset(dataset_name, _load_dataset(dataset_name, config), config,
+                                   with_statistics=True)
+                    descriptor = describe(dataset_name, config)
                 line = [dataset_name,
-                        dataset.size,
-                        np.prod(dataset.input_shape),
-                        max(dataset.outputs_num, 2),
-                        dataset.feature_scale,
-                        dataset.feature_spread
+                        descriptor["train_size"] + descriptor["test_size"],
+                        descriptor["features"],
+                        max(descriptor["outputs"], 2),
+                        descriptor["feature_scale"],
+                        descriptor["feature_spread"],
+                        descriptor["sparsity"]
                         ]
                 lines.append(line)
             import tabulate
 
             print(tabulate.tabulate(lines, header, floatfmt=".2E"))
             exit(0)
+        if isinstance(config["cpu_affinity"], list) and args.concurrent is None:
+            os.sched_setaffinity(0, config["cpu_affinity"])
+        if args.concurrent is not None:
+            if args.halving:
+                raise ValueError("--halving runs sequentially, it can't be combined with --concurrent")
+            run_concurrent(_expand_jobs(datasets, models, optimizers, config), args.concurrent, config,
+                           use_cache=args.cache, tag=args.tag, verbose=args.verbose)
+            exit(0)
+        if args.enqueue is not None:
+            enqueued = JobQueue(args.queue_dir).enqueue(_expand_jobs(datasets, models, optimizers, config))
+            print("Enqueued {} jobs in '{}'".format(enqueued, args.queue_dir))
+            exit(0)
         for dataset_name in datasets:
-            dataset = eval(dataset_name)(**config)
+            dataset = _load_dataset(dataset_name, config)
+            record_dataset(dataset_name, dataset, config)
             for model, model_args in models:
                 print("Running optimizers for dataset: '{}', model: '{}'".format(dataset.get_name(),
                                                                                  _parse_name(model, model_args)))
-                for optimizer_class, optimizer_args in sorted(optimizers, key=lambda x: x[0]):
-                    for _ in range(config["times"]):
-                        try:
-                            test(
-                                dataset=dataset,
-                                model=model,
-                                model_args=model_args,
-                                optimizer_class=optimizer_class,
-                                optimizer_args=optimizer_args,
-                                tag=args.tag,
-                                verbose=args.verbose,
-                                **config)
-                        except Exception as ex:
-                            print("======================= EXCEPTION ===================================")
-                            print("========================== {} =======================================".format(
-                                optimizer_class))
-                            print(ex)
-                            traceback.print_exc(file=sys.stdout)
-                            print("==========================================")
+                model_graph = _ModelGraph(dataset, model, model_args, config["embedding_size"], config["loss"],
+                                          _session_config(config["intra_op_threads"], config["inter_op_threads"]))
+                if args.halving:
+                    successive_halving(dataset, model, model_args, optimizers, config, model_graph=model_graph,
+                                       use_cache=args.cache, tag=args.tag, verbose=args.verbose)
+                else:
+                    for optimizer_class, optimizer_args in sorted(optimizers, key=lambda x: x[0]):
+                        for repeat in range(config["times"]):
+                            _run_test(dataset, model, model_args, optimizer_class, optimizer_args, config,
+                                      repeat=repeat, use_cache=args.cache, model_graph=model_graph, tag=args.tag,
+                                      verbose=args.verbose)
+                model_graph.close()
     except KeyboardInterrupt:
         print()
         print("Keyboard interrupt. Aborting ...")
@@ -2,42 +2,207 @@
 
 from util_plot import *
 import warnings
+import bisect
 from collections import defaultdict
 from matplotlib import pyplot as plt
 import seaborn as sns
 import tensorflow as tf
 import glob
+import hashlib
+import json
 import numpy as np
 import os
+import re
 import itertools as it
 
 from tqdm import tqdm
 
+from checkpoints import RESUMED_FILE
+
+
+def _event_file_time(filename):
+    # events.out.tfevents.<timestamp>.<host>
+    tokens = os.path.basename(filename).split(".")
+    try:
+        return int(tokens[3]), filename
+    except (IndexError, ValueError):
+        return 0, filename
+
+
+def is_resumed(filename):
+    """Whether the run an event file belongs to (<run>/<train|test>/events...) was resumed from a checkpoint."""
+    run_dir = os.path.dirname(os.path.dirname(os.path.abspath(filename)))
+    return os.path.exists(os.path.join(run_dir, RESUMED_FILE))
+
+
+def run_files(filename):
+    """All event files of the run of an event file, oldest first. A resumed run appends to its directory with a new
+    event file, in any other directory every event file is a run of its own."""
+    if not is_resumed(filename):
+        return [filename]
+    return sorted(glob.glob(os.path.join(os.path.dirname(filename), "*events*")), key=_event_file_time)
+
+
+def read_scalars(filename, keys):
+    steps = []
+    values = {key: [] for key in keys}
+    for part in run_files(filename):
+        part_steps, part_values = _read_event_file(part, keys)
+        if len(part_steps) == 0:
+            continue
+        # steps logged after the checkpoint a later file resumed from were logged again
+        n = bisect.bisect_left(steps, part_steps[0])
+        steps = steps[0:n] + part_steps
+        for key in keys:
+            values[key] = values[key][0:n] + part_values[key]
+    return steps, values
+
+
+def _read_event_file(filename, keys):
+    values = {key: [] for key in keys}
+    steps = []
+    try:
+        for event in tf.train.summary_iterator(filename):
+            if event.HasField('summary'):
+                steps.append(event.step)
+                for value in event.summary.value:
+                    key = value.tag.rsplit("/", 1)[-1]
+                    if key in values:
+                        values[key].append(value.simple_value)
+    except:
+        print("Could not read '{}'".format(filename))
+    return steps, values
+
+
+def read_events(filename, key):
+    steps, values = read_scalars(filename, (key,))
+    return steps, values[key]
+
+
+# written by test.py next to the train/test directories of a run aborted by the divergence watchdog
+DIVERGED_FILE = "DIVERGED"
+
+
+def is_diverged(filename):
+    """Whether the run an event file belongs to (<run>/<train|test>/events...) was aborted as diverged."""
+    run_dir = os.path.dirname(os.path.dirname(os.path.abspath(filename)))
+    return os.path.exists(os.path.join(run_dir, DIVERGED_FILE))
+
+
+# run names are "<optimizer>_<arg initial><arg value>_...", e.g. "sgd_dsqrt_l1e-05"
+_NUMERIC_ARG = re.compile(r"^[a-z]([-+.0-9e]+|True|False|None)$")
+
+
+def algo_family(algo):
+    """Run name without its numeric arguments, e.g. "sgd_dsqrt_l1e-05" -> "sgd_dsqrt"."""
+    tokens = algo.split("_")
+    return "_".join(tokens[:1] + [t for t in tokens[1:] if not _NUMERIC_ARG.match(t)])
+
+
+def algo_args(algo):
+    """Numeric arguments of a run name, e.g. "sgd_dsqrt_l1e-05" -> "l1e-05"."""
+    return "_".join(t for t in algo.split("_")[1:] if _NUMERIC_ARG.match(t))
+
+
+class RunningStats(object):
+    """Per-step mean/std/min/max of a series folded in run by run (Welford).
+
+    Runs are aligned on their step values, so runs of different lengths all contribute
+    to the steps they cover.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.steps = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0, dtype=np.float64)
+        self.min = np.zeros(0, dtype=np.float64)
+        self.max = np.zeros(0, dtype=np.float64)
+        self._m2 = np.zeros(0, dtype=np.float64)
+
+    def _align(self, steps):
+        all_steps = np.union1d(self.steps, steps)
+        if len(all_steps) != len(self.steps):
+            indices = np.searchsorted(all_steps, self.steps)
+
+            def expand(array, fill):
+                expanded = np.full(len(all_steps), fill, dtype=array.dtype)
+                expanded[indices] = array
+                return expanded
+
+            self.count = expand(self.count, 0)
+            self.mean = expand(self.mean, 0)
+            self.min = expand(self.min, np.inf)
+            self.max = expand(self.max, -np.inf)
+            self._m2 = expand(self._m2, 0)
+            self.steps = all_steps
+        return np.searchsorted(self.steps, steps)
+
+    def add(self, steps, values):
+        steps = np.asarray(steps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if len(steps) == 0:
+            return
+        # keep the last value logged for a repeated step
+        steps, last = np.unique(steps[::-1], return_index=True)
+        values = values[::-1][last]
+
+        indices = self._align(steps)
+        self.count[indices] += 1
+        delta = values - self.mean[indices]
+        self.mean[indices] += delta / self.count[indices]
+        self._m2[indices] += delta * (values - self.mean[indices])
+        self.min[indices] = np.minimum(self.min[indices], values)
+        self.max[indices] = np.maximum(self.max[indices], values)
+        self.runs += 1
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / np.maximum(self.count, 1))
+
+    @property
+    def shape(self):
+        # same layout as the [runs, 2, steps] arrays of non-streaming trees
+        return self.runs, 2, len(self.steps)
+
 
 # TODO maybe it's a stupid idea, maybe I can do it with pandas?
 # it seems that not really, different datasets and test/train sets will have different dimensionality
 class Tree(object):
-    def __init__(self, key="cross_entropy", verbose=False):
+    def __init__(self, key="cross_entropy", verbose=False, streaming=False):
         def recursive_defaultdict_factory():
             return defaultdict(recursive_defaultdict_factory)
 
         self.root = defaultdict(recursive_defaultdict_factory)
-        self.random_access_data = defaultdict(list)
+        # In streaming mode runs are folded into per-step statistics as they are read,
+        # so memory does not grow with the number of repeated runs
+        self.streaming = streaming
+        self.random_access_data = defaultdict(RunningStats if streaming else list)
         self.datasets = set()
         self.modes = set()
         self.architectures = set()
         self.algorithms = set()
+        self.sources = defaultdict(list)
         self.verbose = verbose
         self.key = key
 
-    def load(self, logdir, filters=None, excludes=None):
+    def find_runs(self, logdir, filters=None, excludes=None):
+        # Only looks at paths, no event file is read here
+        self.sources = defaultdict(list)
         files = glob.glob('{}/**/*events*'.format(logdir), recursive=True)
         if self.verbose:
-            print("Loading files into tree structure")
             print("Found {} files...".format(len(files)))
-        if self.verbose:
-            files = tqdm(files)
+        # one file per resumed run directory, the latest one as it changes when a run is resumed
+        # (read_scalars reads all the files of the directory)
+        runs = []
+        latest = {}
         for filename in files:
+            directory = os.path.dirname(filename)
+            if not is_resumed(filename):
+                runs.append(filename)
+            elif directory not in latest or _event_file_time(filename) > _event_file_time(latest[directory]):
+                latest[directory] = filename
+        for filename in sorted(runs + list(latest.values())):
             tokens = [x.strip("_") for x in filename.strip().split("/")]
             stop = False
             if filters is not None and len(filters) > 0:
@@ -64,22 +229,23 @@ class Tree(object):
             self.architectures.add(architecture)
             self.algorithms.add(algo)
 
-            tokens_list = [dataset, mode, architecture, algo]
-            values = []
-            steps = []
-            try:
-                for event in tf.train.summary_iterator(filename):
-                    if event.HasField('summary'):
-                        steps.append(event.step)
-                        for value in event.summary.value:
-                            if value.tag.endswith("/" + self.key):
-                                values.append(value.simple_value)
-            except:
-                print("Could not read '{}'".format(filename))
+            self.sources[(dataset, mode, architecture, algo)].append(filename)
+        return self.sources
+
+    def load(self, logdir, filters=None, excludes=None, keys=None):
+        self.find_runs(logdir, filters, excludes)
+        if keys is None:
+            keys = list(self.sources)
+        files = [(key, filename) for key in keys for filename in self.sources[key]]
+        if self.verbose:
+            print("Loading {} files into tree structure".format(len(files)))
+            files = tqdm(files)
+        for tokens_list, filename in files:
+            steps, values = read_events(filename, self.key)
 
             data = [steps[1:], values[1:]]
 
-            self._add_leaf(tokens_list, data)
+            self._add_leaf(list(tokens_list), data)
 
         self._convert_lists_to_arrays()
         self._index()
@@ -109,7 +275,10 @@ class Tree(object):
         for t in tokens:
             current_dict = current_dict[t]
         key = tuple(tokens)
-        self.random_access_data[key].append(series)
+        if self.streaming:
+            self.random_access_data[key].add(*series)
+        else:
+            self.random_access_data[key].append(series)
 
     def _print_recursive(self, item, indent_level=0):
         if isinstance(item, dict):
@@ -137,23 +306,222 @@ class Tree(object):
 
     def _convert_lists_to_arrays(self, root=None):
         for tokens, series in self.random_access_data.items():
-            self.random_access_data[tuple(tokens)] = self._lists_to_array(series)
+            if not self.streaming:
+                self.random_access_data[tuple(tokens)] = self._lists_to_array(series)
             leaf = self.root
             for token in tokens[0:-1]:
                 leaf = leaf[token]
             leaf[tokens[-1]] = self.random_access_data[tuple(tokens)]
 
 
-def save_plot(path, extension="pdf", logscale=False, verbose=False):
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: indices of n_out points preserving the shape of y(x)."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # first and last points are always kept, the rest is split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.zeros(n_out, dtype=np.int64)
+    indices[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + np.argmax(areas)
+        indices[i + 1] = a
+    return indices
+
+
+def minmax_indices(x, y, n_out):
+    """Indices of both ends and of the minimum and maximum of y in each of (n_out - 2) / 2 buckets."""
+    n = len(x)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+    edges = np.linspace(0, n, (n_out - 2) // 2 + 1).astype(np.int64)
+    indices = [0, n - 1]
+    for start, end in zip(edges[:-1], edges[1:]):
+        indices.append(start + np.argmin(y[start:end]))
+        indices.append(start + np.argmax(y[start:end]))
+    return np.unique(indices)
+
+
+DOWNSAMPLERS = {"lttb": lttb_indices, "minmax": minmax_indices}
+
+
+def downsample_indices(x, y, max_points=None, method="lttb"):
+    if max_points is None or max_points <= 0:
+        return np.arange(len(x))
+    return DOWNSAMPLERS[method](x, y, max_points)
+
+
+def plot_running_stats(stats,
+                       condition=None,
+                       value=None,
+                       color=None,
+                       marker=None,
+                       err_style="ci_band",
+                       linewidth=1,
+                       markersize=4,
+                       max_points=None,
+                       downsample="lttb",
+                       ax=None,
+                       **kwargs):
+    if ax is None:
+        ax = plt.gca()
+    steps = stats.steps
+    mean = stats.mean
+    if err_style == "unit_traces":
+        # single runs are not kept, show their envelope instead
+        lower, upper = stats.min, stats.max
+        alpha = 0.1
+    else:
+        lower, upper = mean - stats.std, mean + stats.std
+        alpha = 0.2
+    # the band is cut at the points picked for the mean so it stays aligned with the line
+    indices = downsample_indices(steps, mean, max_points, downsample)
+    steps, mean, lower, upper = steps[indices], mean[indices], lower[indices], upper[indices]
+    line, = ax.plot(steps, mean,
+                    label=condition,
+                    color=color,
+                    marker=marker,
+                    linewidth=linewidth,
+                    markersize=markersize)
+    ax.fill_between(steps, lower, upper, color=line.get_color(), alpha=alpha, linewidth=0)
+    if value is not None:
+        ax.set_ylabel(value)
+    if condition is not None:
+        ax.legend(loc=0)
+    return ax
+
+
+class BuildCache(object):
+    """Remembers what every output figure was made from, to re-render only stale ones (make-style).
+
+    A figure is fresh if it exists and neither its input files (mtime, size) nor its plot
+    parameters changed since it was last rendered.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.entries = json.load(file)
+
+    @staticmethod
+    def signature(files, params):
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode())
+        for filename in sorted(set(files)):
+            stat = os.stat(filename)
+            digest.update("{}:{}:{}".format(filename, stat.st_mtime_ns, stat.st_size).encode())
+        return digest.hexdigest()
+
+    def is_fresh(self, output, signature):
+        return self.entries.get(output) == signature and os.path.exists(output)
+
+    def update(self, output, signature):
+        self.entries[output] = signature
+
+    def lookup(self, key, signature):
+        """Value stored under key with the same signature, None if there is none."""
+        entry = self.entries.get(key)
+        if isinstance(entry, dict) and entry.get("signature") == signature:
+            return entry["value"]
+        return None
+
+    def store(self, key, signature, value):
+        self.entries[key] = {"signature": signature, "value": value}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.entries, file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def stale_jobs(jobs, tree, cache, params, force=False):
+    """Signs every render job with its runs' event files and parameters, returns the stale ones."""
+    stale = []
+    for job in jobs:
+        files = list(job.get("files", []))
+        for tags in job.get("tag_sets", []):
+            files += tree.sources[tuple(tags)]
+        job["output"] = plot_path(job["path"], params["extension"])
+        job["signature"] = cache.signature(files, dict(params, **{k: v for k, v in job.items()
+                                                                  if k not in ("output", "signature")}))
+        if force or not cache.is_fresh(job["output"], job["signature"]):
+            stale.append(job)
+    return stale
+
+
+def job_keys(jobs):
+    return sorted({tuple(tags) for job in jobs for tags in job.get("tag_sets", [])})
+
+
+def plot_path(path, extension="pdf"):
     if not extension.startswith("."):
         extension = "." + extension
     if not path.endswith(extension):
         path += extension
+    return path
+
+
+def save_plot(path, extension="pdf", logscale=False, verbose=False, fig=None):
+    path = plot_path(path, extension)
 
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    if not logscale:
-        plt.locator_params(nbins=6)
-    if verbose:
-        print("Saving {}".format(path))
-    plt.savefig(path,bbox_inches='tight')
-    plt.clf()
+    if fig is None:
+        if not logscale:
+            plt.locator_params(nbins=6)
+        if verbose:
+            print("Saving {}".format(path))
+        plt.savefig(path,bbox_inches='tight')
+        plt.clf()
+    else:
+        if not logscale:
+            for ax in fig.axes:
+                ax.locator_params(nbins=6)
+        if verbose:
+            print("Saving {}".format(path))
+        fig.savefig(path, bbox_inches='tight')
+
+
+def new_figure():
+    # Figures detached from pyplot's global state can be drawn in any process/thread
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot(111)
+
+
+_shared_data = None
+
+
+def _run_render_job(render_and_job):
+    render, job = render_and_job
+    return render(job, _shared_data)
+
+
+def render_jobs(render, jobs, shared=None, processes=None):
+    """Calls render(job, shared) for every job in a pool of forked processes, returns the results in order.
+
+    `shared` (e.g. a loaded Tree) is not pickled, forked workers see it copy-on-write.
+    """
+    global _shared_data
+    _shared_data = shared
+    if processes == 1 or len(jobs) <= 1:
+        return [render(job, shared) for job in tqdm(jobs, leave=False)]
+    import multiprocessing
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        return list(tqdm(pool.imap(_run_render_job, [(render, job) for job in jobs]),
+                         total=len(jobs),
+                         leave=False))